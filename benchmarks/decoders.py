@@ -0,0 +1,69 @@
+"""
+Compare the decode time of every available decoder per transfer syntax (pixels.DECODERS).
+
+python benchmarks/decoders.py [-i path/to/dicoms] [-n files] [-f frames] [-r repeats]
+
+Without --input, synthetic multi-frame files are written to a temporary directory, uncompressed and RLE compressed.
+"""
+import os, time, tempfile, warnings
+from collections import defaultdict
+from pathlib import Path
+
+import click
+import numpy as np
+import pydicom
+from pydicom.uid import RLELossless, UID
+
+from dataviewer import pixels
+from headers import write_multiframe
+
+
+def measure(path, name, repeats):
+    timings = []
+    for _ in range(repeats):
+        dcm = pydicom.dcmread(path)
+        t = time.perf_counter()
+        pixels.decode(dcm, path, name)
+        timings.append(time.perf_counter() - t)
+    return np.mean(timings)
+
+
+@click.command()
+@click.option('-i', '--input', 'input', type=click.Path(exists=True, file_okay=False, path_type=Path),
+              help="Benchmark on *.dcm files in this directory rather than synthetic files.")
+@click.option('-n', '--files', 'files', type=int, default=3, help="Number of synthetic files per transfer syntax.")
+@click.option('-f', '--frames', 'frames', type=int, default=20, help="Number of frames per synthetic file.")
+@click.option('-r', '--repeats', 'repeats', type=int, default=3)
+def main(input: Path, files: int, frames: int, repeats: int):
+    warnings.simplefilter('ignore')
+    with tempfile.TemporaryDirectory() as tmp:
+        if input:
+            paths = sorted(str(p) for p in input.rglob('*.dcm'))
+        else:
+            paths = [os.path.join(tmp, f'{i}.dcm') for i in range(files)]
+            [write_multiframe(p, frames) for p in paths]
+            for i, path in enumerate(paths[:]):
+                dcm = pydicom.dcmread(path)
+                dcm.compress(RLELossless)
+                dcm.save_as(path := os.path.join(tmp, f'{i}_rle.dcm'))
+                paths.append(path)
+
+        by_syntax = defaultdict(list)
+        for path in paths:
+            by_syntax[str(pydicom.dcmread(path, stop_before_pixels=True).file_meta.TransferSyntaxUID)].append(path)
+
+        for syntax, paths in by_syntax.items():
+            click.echo(f'{UID(syntax).name} ({len(paths)} files)')
+            for name in pixels.decoders(syntax):
+                try:
+                    seconds = np.mean([measure(p, name, repeats) for p in paths])
+                    click.echo(f'  {name:<12} {seconds * 1000:8.2f} ms/file')
+                except Exception as e:
+                    click.echo(f'  {name:<12} failed: {str(e).splitlines()[0]}')
+            unavailable = [n for n in pixels.DECODERS.get(syntax, pixels.DEFAULT_DECODERS) if not pixels.decoder_available(n)]
+            if unavailable:
+                click.echo(f'  not installed: {", ".join(unavailable)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Compare full DICOM reads against header-only, tag-targeted reads (db.read_header).
+
+python benchmarks/headers.py [-i path/to/dicoms] [-n files] [-f frames] [-r repeats]
+
+Without --input, synthetic enhanced multi-frame files are written to a temporary directory.
+"""
+import io, os, time, tempfile
+from pathlib import Path
+
+import click
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.sequence import Sequence
+from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+from dataviewer import db
+
+
+class CountingFile(io.RawIOBase):
+    def __init__(self, path):
+        self._f = open(path, 'rb')
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._f.readinto(b)
+        self.bytes_read += n or 0
+        return n
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+def write_multiframe(path: Path, frames: int, rows: int = 512, columns: int = 512):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4.1'  # Enhanced MR
+    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID = generate_uid()
+    ds.StudyInstanceUID, ds.SeriesInstanceUID = generate_uid(), generate_uid()
+    ds.PatientID, ds.Modality, ds.StudyDate, ds.SeriesDescription = 'BENCH', 'MR', '20200101', 'enhanced'
+    ds.Rows, ds.Columns, ds.NumberOfFrames = rows, columns, frames
+    ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+    ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+
+    def frame_group(i):
+        position, plane = Dataset(), Dataset()
+        position.ImagePositionPatient = [0, 0, i]
+        plane.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+        group = Dataset()
+        group.PlanePositionSequence = Sequence([position])
+        group.PlaneOrientationSequence = Sequence([plane])
+        return group
+
+    ds.PerFrameFunctionalGroupsSequence = Sequence([frame_group(i) for i in range(frames)])
+    ds.PixelData = np.random.randint(0, 4096, (frames, rows, columns), dtype=np.uint16).tobytes()
+    ds.is_little_endian, ds.is_implicit_VR = True, False
+    ds.save_as(path, write_like_original=False)
+
+
+def measure(read, paths, repeats):
+    timings, bytes_read = [], 0
+    for _ in range(repeats):
+        for path in paths:
+            f = CountingFile(path)
+            t = time.perf_counter()
+            read(f)
+            timings.append(time.perf_counter() - t)
+            bytes_read += f.bytes_read
+            f.close()
+    return np.mean(timings), bytes_read / len(timings)
+
+
+@click.command()
+@click.option('-i', '--input', 'input', type=click.Path(exists=True, file_okay=False, path_type=Path),
+              help="Benchmark on *.dcm files in this directory rather than synthetic files.")
+@click.option('-n', '--files', 'files', type=int, default=5, help="Number of synthetic files.")
+@click.option('-f', '--frames', 'frames', type=int, default=100, help="Number of frames per synthetic file.")
+@click.option('-r', '--repeats', 'repeats', type=int, default=3)
+def main(input: Path, files: int, frames: int, repeats: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        if input:
+            paths = sorted(str(p) for p in input.rglob('*.dcm'))
+        else:
+            paths = [os.path.join(tmp, f'{i}.dcm') for i in range(files)]
+            [write_multiframe(p, frames) for p in paths]
+        size = np.mean([os.path.getsize(p) for p in paths])
+        click.echo(f'{len(paths)} files, {size / 2 ** 20:.1f} MiB on average\n')
+
+        for name, read in [('dcmread (full)', pydicom.dcmread), ('db.read_header', db.read_header)]:
+            seconds, bytes_read = measure(read, paths, repeats)
+            click.echo(f'{name:<16} {seconds * 1000:8.2f} ms/dossier {bytes_read / 2 ** 10:12.1f} KiB read/dossier')
+
+
+if __name__ == '__main__':
+    main()
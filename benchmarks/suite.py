@@ -0,0 +1,204 @@
+"""
+Time ingest, queries, tree construction and preview decoding on synthetic archives.
+
+python benchmarks/suite.py [-p patients] [--studies n] [--series n] [--slices n] [-o results.json] [-b baseline.json]
+
+Archives of patients x studies x series x slices are generated with pydicom in a temporary directory, once
+uncompressed and once RLE compressed. Timings (seconds, best of --repeats) are written to --output as JSON,
+and compared against a previous output with --baseline.
+"""
+import os, sys, json, time, sqlite3, platform, tempfile, warnings
+from pathlib import Path
+
+import click
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, RLELossless, generate_uid
+
+from dataviewer import db, viewport
+
+COMPRESSIONS = {'uncompressed': None, 'rle': RLELossless}
+DESCRIPTIONS = ['t2_tse_tra', 'ep2d_diff_b50_800', 'tse_dixon_cor', 'localizer']
+
+
+def write_archive(root: Path, patients: int, studies: int, series: int, slices: int, size: int, compression=None):
+    """Writes PatientID/Study/Series/slice.dcm files, modalities alternate per patient, descriptions per series."""
+    ramp = np.add.outer(np.arange(size), np.arange(size)).astype(np.uint16)
+    for p in range(patients):
+        for st in range(studies):
+            study_uid = generate_uid()
+            for se in range(series):
+                ds = Dataset()
+                ds.file_meta = FileMetaDataset()
+                ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+                ds.file_meta.MediaStorageSOPClassUID = ds.SOPClassUID = '1.2.840.10008.5.1.4.1.1.4'  # MR
+                ds.PatientID, ds.StudyInstanceUID, ds.SeriesInstanceUID = f'P{p:05}', study_uid, generate_uid()
+                ds.Modality = ['MR', 'CT'][p % 2]
+                ds.StudyDate = ds.SeriesDate = f'2020{st % 12 + 1:02}01'
+                ds.StudyDescription, ds.SeriesDescription = f'study {st}', DESCRIPTIONS[se % len(DESCRIPTIONS)]
+                ds.EchoTime, ds.RepetitionTime, ds.SliceThickness = 80 + se, 3000, 3
+                ds.WindowCenter, ds.WindowWidth = 2048, 4096
+                ds.Rows = ds.Columns = size
+                ds.SamplesPerPixel, ds.PhotometricInterpretation = 1, 'MONOCHROME2'
+                ds.BitsAllocated, ds.BitsStored, ds.HighBit, ds.PixelRepresentation = 16, 12, 11, 0
+                ds.PixelData = ((ramp * (se + 1)) % 4096).tobytes()
+                if compression:
+                    # every slice shares the pixels of its series, so only compress once
+                    ds.compress(compression)
+
+                directory = root / ds.PatientID / f'ST{st}' / f'SE{se}'
+                directory.mkdir(parents=True)
+                for i in range(slices):
+                    ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID = generate_uid()
+                    ds.InstanceNumber, ds.ImagePositionPatient = i + 1, [0, 0, i * 3]
+                    ds.save_as(directory / f'{i:04}.dcm', write_like_original=False)
+
+
+def best(f, repeats: int):
+    """Returns the fastest of repeated calls in seconds, along with the result of the last call."""
+    timings = []
+    for _ in range(repeats):
+        t = time.perf_counter()
+        result = f()
+        timings.append(time.perf_counter() - t)
+    return min(timings), result
+
+
+def ingest(input: Path, tmp: Path, workers: int, executor: str, repeats: int):
+    results = dict()
+    results['walk'], dossiers = best(lambda: list(db.walk(input, workers)), repeats)
+
+    def process():
+        # fresh Dossiers, they cache their headers once read
+        rows = []
+        db.process([db.Dossier(d.input_dir, d.dcm_dir, d.dcms, d.fingerprint) for d in dossiers],
+                   lambda *r: rows.append(r), workers, executor)
+        return rows
+    results['process'], rows = best(process, repeats)
+
+    def write():
+        (output := tmp / 'write.db').unlink(missing_ok=True)
+        with (conn := sqlite3.connect(output)):
+            db.create_tables(conn)
+        conn.close()
+        (writer := db.Writer(output)).start()
+        [writer.put(*r) for r in rows]
+        writer.close()
+    results['write'], _ = best(write, repeats)
+
+    def indexes():
+        with (conn := sqlite3.connect(tmp / 'write.db')):
+            [conn.execute(f"DROP INDEX IF EXISTS idx_{db.TABLE_DOSSIERS}_{c}") for c in db.INDEXED]
+            conn.execute(f"DROP TABLE IF EXISTS {db.TABLE_TEXT}")
+            db.create_indexes(conn)
+        conn.close()
+    results['indexes'], _ = best(indexes, repeats)
+
+    output = tmp / 'archive.db'
+    results['create'], _ = best(lambda: db.create(input, output, workers, executor), repeats)
+    results['update_unchanged'], _ = best(lambda: db.update(input, output, workers, executor), repeats)
+    return output, results
+
+
+def query(path: Path, repeats: int):
+    conn = db.Connection(path)
+    selections = {
+        'patient': {'PatientID': 'P00000'},
+        'description': {'SeriesDescription': 'dixon'},
+        'modality': {'Modality': 'MR'},
+        'all': {},
+    }
+    results = {'select_all': best(conn.select_all, repeats)[0]}
+    for name, kvp in selections.items():
+        results[f'select_{name}'], (rows, _) = best(lambda: conn.select(include_siblings=False, **kvp), repeats)
+        results[f'select_{name}_rows'] = len(rows)
+    return results
+
+
+def tree(path: Path, input: Path, repeats: int):
+    import dearpygui.dearpygui as dpg
+    # the viewport is created but never shown
+    viewer = viewport.Viewer(db.Connection(path), input, {'Modality': 'MR'})
+    try:
+        dpg.add_texture_registry(tag='textures')
+        with dpg.theme(tag='theme_select'):
+            pass
+
+        def populate():
+            viewer.patients = dict()
+            with dpg.window() as viewer.explorer:
+                pass
+            viewer.populate_tree().join()
+            return viewer.explorer
+
+        def expand_all():
+            patients = dpg.get_item_children(populate(), 1)
+            for patient in patients:
+                viewer.callback_expand(None, patient)
+                [viewer.callback_expand(None, study) for study in dpg.get_item_children(patient, 1)]
+
+        return {'tree_patients': best(populate, repeats)[0], 'tree_expand_all': best(expand_all, repeats)[0]}
+    finally:
+        dpg.destroy_context()
+
+
+def preview(path: Path, input: Path, repeats: int, samples: int = 20):
+    conn = db.Connection(path)
+    paths = [os.path.join(input, row['Path'], row['Sample']) for row in conn.select_all()[:samples]]
+    return {'preview': best(lambda: [viewport.load_preview(p) for p in paths], repeats)[0] / len(paths)}
+
+
+def compare(results: dict, baseline: dict, prefix: str = ''):
+    for key, value in results.items():
+        if isinstance(value, dict):
+            compare(value, baseline.get(key, {}), f'{prefix}{key}.')
+        elif isinstance(base := baseline.get(key), float) and base > 0:
+            click.echo(f'{prefix + key:<40} {value:10.4f} s {value / base:8.2f}x baseline')
+
+
+@click.command()
+@click.option('-p', '--patients', 'patients', type=int, default=20)
+@click.option('--studies', 'studies', type=int, default=2, help="Per patient.")
+@click.option('--series', 'series', type=int, default=4, help="Per study.")
+@click.option('--slices', 'slices', type=int, default=10, help="Per series.")
+@click.option('--size', 'size', type=int, default=128, help="Rows and columns of every slice.")
+@click.option('-c', '--compression', 'compressions', type=click.Choice(list(COMPRESSIONS)), multiple=True,
+              default=list(COMPRESSIONS), help="Archive variants to benchmark, all by default.")
+@click.option('-w', '--workers', 'workers', type=int, default=None)
+@click.option('-e', '--executor', 'executor', type=click.Choice(['process', 'thread']), default='process')
+@click.option('-r', '--repeats', 'repeats', type=int, default=3)
+@click.option('-o', '--output', 'output', type=click.Path(dir_okay=False, path_type=Path), default='benchmark.json')
+@click.option('-b', '--baseline', 'baseline', type=click.Path(exists=True, dir_okay=False, path_type=Path),
+              help="A previous output to compare against.")
+def main(patients, studies, series, slices, size, compressions, workers, executor, repeats, output, baseline):
+    warnings.simplefilter('ignore')
+    report = {
+        'config': dict(patients=patients, studies=studies, series=series, slices=slices, size=size,
+                       workers=workers, executor=executor, repeats=repeats),
+        'environment': dict(python=sys.version.split()[0], platform=platform.platform(), cpus=os.cpu_count(),
+                            sqlite=sqlite3.sqlite_version, pydicom=pydicom.__version__, numpy=np.__version__),
+        'results': dict(),
+    }
+    for compression in compressions:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp, results = Path(tmp), dict()
+            click.echo(f'Generating {compression} archive')
+            input = tmp / 'archive'
+            results['generate'], _ = best(lambda: write_archive(input, patients, studies, series, slices, size,
+                                                                COMPRESSIONS[compression]), 1)
+
+            path, results['ingest'] = ingest(input, tmp, workers, executor, repeats)
+            results['query'] = query(path, repeats)
+            results['tree'] = tree(path, input, repeats)
+            results['preview'] = preview(path, input, repeats)
+            report['results'][compression] = results
+
+    output.write_text(json.dumps(report, indent=2))
+    click.echo(f'Results written to {output}')
+    if baseline:
+        compare(report['results'], json.loads(baseline.read_text())['results'])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1 @@
 from dataviewer.cli import cli
-
-cli()
\ No newline at end of file
@@ -0,0 +1,5 @@
+from dataviewer.cli import cli
+
+# worker processes import the main module again
+if __name__ == '__main__':
+    cli()
@@ -1,12 +1,12 @@
+import re
 from pathlib import Path
 
 import click
 
-from dataviewer import db
-from dataviewer import viewport
-from dataviewer import version
+# db and viewport load pydicom, SimpleITK, pandas and dearpygui, they are only imported by the commands using them
+from dataviewer import tags
 
-(valid_keys := list(set(db.dcm_tags.values()))).sort()
+(valid_keys := list(set(tags.dcm_tags.values()))).sort()
 
 
 @click.group()
@@ -17,7 +17,8 @@ def cli():
 @cli.command(name='version')
 def version():
     """Prints package version."""
-    click.echo(f'{__package__} v{version.__version__}')
+    from dataviewer.version import __version__
+    click.echo(f'{__package__} v{__version__}')
 
 
 @cli.command(name='keys')
@@ -37,73 +38,203 @@ def keys(output: bool):
               help="Read data from this directory.", prompt='Enter path/to/data_directory', default='.')
 @click.option('-o', '--output', 'output', type=click.Path(resolve_path=True, path_type=Path),
               help="Output database to this path.", prompt='Enter output path/to/database', default='./rumc_database.db')
-def new(input: Path, output: Path):
-    """Create a database given a RUMC data directory. Overwrites existing databases in cwd."""
+@click.option('-w', '--workers', 'workers', type=click.IntRange(min=1),
+              help="Number of header extraction workers, defaults to the number of CPUs.")
+@click.option('-e', '--executor', 'executor', type=click.Choice(['process', 'thread']), default='process',
+              help="Extract headers in worker processes or threads.")
+@click.option('-r', '--resume', 'resume', is_flag=True,
+              help="Continue an interrupted build of the output database, skipping finished DICOM directories.")
+@click.option('-c', '--checkpoint', 'checkpoint', type=click.IntRange(min=1),
+              help="Commit progress every this many DICOM directories, defaults to 4096.")
+@click.option('-t', '--thumbnails', 'thumbnails', type=click.IntRange(min=1),
+              help="Store window-levelled thumbnails of at most this size, so previews work without the source directory.")
+@click.option('-s', '--stats', 'stats', type=click.Path(dir_okay=False, path_type=Path),
+              help="Write timings, throughput and failures of every phase to this JSON file.")
+@click.option('-n', '--instances', 'instances', is_flag=True,
+              help="Also store SOPInstanceUID, InstanceNumber, position, acquisition time and size of every file.")
+@click.option('-k', '--shard', 'shard', callback=lambda ctx, param, value: parse_shard(value),
+              help="Only read the K-th of N shares of the top-level directories, as K/N. Combine shards using 'merge'.")
+def new(input: Path, output: Path, workers: int, executor: str, resume: bool, checkpoint: int, thumbnails: int,
+        stats: Path, instances: bool, shard: tuple):
+    """Create a database given a RUMC data directory. Overwrites existing databases unless --resume is given."""
+    from dataviewer import db
     if not input.is_dir():
         raise NotADirectoryError("Expected input to be a directory")
     if output.is_dir():
         raise IsADirectoryError("Expected output to be a file")
-    db.create(input.absolute(), output.with_suffix('.db').absolute())
+    db.create(input.absolute(), output.with_suffix('.db').absolute(), workers, executor, resume,
+              checkpoint or db.COMMIT_SIZE, thumbnails, stats, instances, shard)
+
+
+def parse_shard(value: str):
+    if value is None:
+        return None
+    if match := re.match(r'^(\d+)/(\d+)$', value.strip()):
+        k, n = int(match.group(1)), int(match.group(2))
+        if 1 <= k <= n:
+            return k, n
+    raise click.BadParameter("Expected K/N with 1 <= K <= N, e.g. 1/4")
+
+
+@cli.command(name='merge')
+@click.option('-i', '--input', 'inputs', multiple=True, required=True,
+              type=click.Path(resolve_path=True, path_type=Path, exists=True, dir_okay=False),
+              help="Merge this database, e.g. created by 'new --shard', repeat for every database.")
+@click.option('-o', '--output', 'output', type=click.Path(resolve_path=True, path_type=Path),
+              help="Output the merged database to this path, overwriting it.", prompt='Enter output path/to/database')
+def merge(inputs: tuple, output: Path):
+    """Merge databases created from the same data directory into one."""
+    from dataviewer import db
+    output = output.with_suffix('.db')
+    if output in inputs:
+        raise click.BadParameter("The output can not be one of the inputs", param_hint='output')
+    db.merge(list(inputs), output)
+
+
+@cli.command(name='update')
+@click.option('-o', '--output', 'output', type=click.Path(resolve_path=True, path_type=Path, exists=True, dir_okay=False),
+              help="Update this database in place.", prompt='Enter path/to/database')
+@click.option('-i', '--input', 'input', type=click.Path(resolve_path=True, path_type=Path),
+              help="Read data from this directory, defaults to the directory the database was created from.")
+@click.option('-w', '--workers', 'workers', type=click.IntRange(min=1),
+              help="Number of header extraction workers, defaults to the number of CPUs.")
+@click.option('-e', '--executor', 'executor', type=click.Choice(['process', 'thread']), default='process',
+              help="Extract headers in worker processes or threads.")
+@click.option('-t', '--thumbnails', 'thumbnails', type=click.IntRange(min=1),
+              help="Store thumbnails of at most this size, defaults to the size of existing thumbnails.")
+@click.option('-n', '--instances', 'instances', is_flag=True,
+              help="Store every file in the Instances table, implied if the database already has instances.")
+def update(output: Path, input: Path, workers: int, executor: str, thumbnails: int, instances: bool):
+    """Update a database, only re-indexing new or changed DICOM directories."""
+    from dataviewer import db
+    if input is None:
+        try:
+            input = Path(db.Connection(output).input())
+        except:
+            raise click.UsageError("Could not read the input directory from the database, please provide --input")
+    if not input.is_dir():
+        raise NotADirectoryError("Expected input to be a directory")
+    db.update(input.absolute(), output.absolute(), workers, executor, thumbnails, instances)
+
+
+@cli.command(name='serve')
+@click.option('-i', '--input', 'input', type=click.Path(resolve_path=True, path_type=Path, exists=True, dir_okay=False),
+              help="Serve this RUMC database file.", prompt='Enter RUMC database file (create using the \'new\' command)')
+@click.option('-h', '--host', 'host', default='127.0.0.1', show_default=True,
+              help="Listen on this address, the API has no authentication so keep it local.")
+@click.option('-p', '--port', 'port', type=click.IntRange(min=0, max=65535), default=8765, show_default=True)
+@click.option('-c', '--connections', 'connections', type=click.IntRange(min=1), default=4, show_default=True,
+              help="Number of pooled read-only connections, and so of concurrently answered queries.")
+@click.option('-m', '--cache', 'cache', type=click.IntRange(min=0), default=256, show_default=True,
+              help="MiB of cached query responses, and as many of thumbnails and previews.")
+def serve(input: Path, host: str, port: int, connections: int, cache: int):
+    """Keep a database open for 'load' and 'export --server', over a local HTTP/JSON API."""
+    from dataviewer import server
+    server.serve(input, host, port, connections, cache * 2 ** 20)
+
+
+def connect(input: Path, url: str):
+    """Opens the database file, or a RemoteConnection to a 'serve' URL."""
+    if url:
+        from dataviewer.server import RemoteConnection
+        return RemoteConnection(url)
+    from dataviewer import db
+    if input is None:
+        input = click.prompt('Enter RUMC database file (create using the \'new\' command)',
+                             type=click.Path(resolve_path=True, path_type=Path, exists=True, dir_okay=False))
+    return db.Connection(input)
 
 
 @cli.command(name='load')
 @click.option('-i', '--input', 'input', type=click.Path(resolve_path=True, path_type=Path, exists=True, dir_okay=False),
-              help="Load and view a RUMC database file.",
-              prompt='Enter RUMC database file (create using the \'new\' command)')
+              help="Load and view a RUMC database file.")
+@click.option('--server', 'url', help="View the database of a running 'serve' command at this URL instead of a file.")
 @click.option('-a', '--all', 'all', is_flag=True,
               help="View entire database without selections.")
 @click.option('-s', '--select', 'selection', multiple=True, type=str,
-              help="View database with selection, as key=value items. e.g. -s SeriesDescription=naald,nld -s Modality=MR")
-def load(input: Path, all: bool, selection):
+              help="View database with selection, as key=value items. e.g. -s SeriesDescription=naald,nld -s Modality=MR. "
+                   "Numeric and date keys match exactly or by comparison and range, "
+                   "e.g. -s EchoTime>80 -s StudyDate=2020-01-01..2021-06-30. "
+                   f"{', '.join(k for k in tags.INDEXED if tags.COLUMN_TYPES[k] == 'TEXT')} match exactly, ignoring case, "
+                   "other keys match substrings.")
+def load(input: Path, url: str, all: bool, selection):
     """Load a database for later use."""
+    from dataviewer import viewport
     try:
         kvp = {}
         if not all:
             if len(selection) > 0:
                 for value in selection:
                     k, v = process_selection(value)
-                    kvp[k] = v
+                    if k and v:
+                        kvp[k] = v
             else:
                 click.echo('Create a selection by submitting a list of dicom metadata key=value items')
                 click.echo('Valid keys are found in keys.txt (case sensitive!), try \'dataviewer --keys\'\n')
                 click.echo('e.g. SeriesDescription=naald,nld\n')
                 click.echo(
                     'creates a selection of series where dicom metadata Series Description contains either \'naald\' or \'nld\'')
+                click.echo('Numeric and date keys also take comparisons and ranges, e.g. EchoTime>80 or StudyDate=2020-01-01..2021-06-30\n')
                 click.echo('A blank input is considered the end of the list of key=value items\n')
                 while value := click.prompt(f'key=value ({len(kvp) + 1})', type=str, default=''):
                     k, v = process_selection(value)
                     if k and v:
                         kvp[k] = v
 
-        conn = db.Connection(input)
+        conn = connect(input, url)
 
-        click.echo(f'Loading {input}...')
+        click.echo(f'Loading {conn.name}...')
 
-        try:
-            db_input_path = Path(conn._c.execute("SELECT * FROM InputPath").fetchone()[1])
-        except:
-            db_input_path = ''
+        db_input_path = Path(conn.input() or '')
 
-        if len(kvp) > 0:
-            selection, series = conn.select(**kvp)
-            viewport.Viewer(input, db_input_path, selection, kvp, series).run()
-        else:
-            viewport.Viewer(input, db_input_path, conn.select_all()).run()
+        # the viewer streams rows from the connection rather than holding a selection in memory
+        viewport.Viewer(conn, db_input_path, kvp if len(kvp) > 0 else None).run()
     except Exception as e:
         click.echo(e)
 
 
+@cli.command(name='export')
+@click.option('-i', '--input', 'input', type=click.Path(resolve_path=True, path_type=Path, exists=True, dir_okay=False),
+              help="Export from this RUMC database file.")
+@click.option('--server', 'url', help="Export from the database of a running 'serve' command at this URL instead of a file.")
+@click.option('-o', '--output', 'output', type=click.Path(resolve_path=True, path_type=Path, dir_okay=False),
+              help="Write rows to this .csv, .jsonl or .parquet file.", prompt='Enter output path/to/export.csv')
+@click.option('-s', '--select', 'selection', multiple=True, type=str,
+              help="Export the series matching these key=value items, as in 'load'. Exports everything if omitted.")
+@click.option('-f', '--format', 'format', type=click.Choice(['csv', 'jsonl', 'parquet']),
+              help="Output format, defaults to the suffix of the output path.")
+@click.option('--siblings/--no-siblings', 'siblings', default=True, show_default=True,
+              help="Include the other series of selected studies, flagged by the Selected column.")
+def export(input: Path, url: str, output: Path, selection, format: str, siblings: bool):
+    """Export a selection without the viewer, streaming rows to a file."""
+    from tqdm import tqdm
+    from dataviewer import db
+    from dataviewer.export import export as export_rows
+
+    # unlike load, nobody is watching, so a dropped item would silently export the wrong cohort
+    kvp = {}
+    for value in selection:
+        try:
+            k, v = db.parse_selection(value)
+        except ValueError as e:
+            raise click.BadParameter(f"{value}, {e}", param_hint="'-s' / '--select'")
+        kvp[k] = v
+
+    try:
+        conn = connect(input, url)
+        with tqdm(total=conn.count(siblings, **kvp), unit='rows') as progress:
+            [progress.update(n) for n in export_rows(conn, output, format, siblings, **kvp)]
+        click.echo(f'Exported {progress.n} rows to {output}')
+    except Exception as e:
+        # a failed export exits non-zero
+        raise click.ClickException(str(e))
+
+
 def process_selection(value: str):
+    from dataviewer import db
     if len(value) > 0:
-        if '=' in value:
-            if not value.endswith('='):
-                k, v = value.split('=', maxsplit=1)
-                if k in valid_keys:
-                    return k, v
-                else:
-                    click.echo('Ignored input, invalid key')
-            else:
-                click.echo('Ignored input, empty value')
-        else:
-            click.echo('Ignored input, no \'=\' found')
-    return False, False
\ No newline at end of file
+        try:
+            return db.parse_selection(value)
+        except ValueError as e:
+            click.echo(f'Ignored input, {e}')
+    return False, False
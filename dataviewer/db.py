@@ -1,95 +1,107 @@
-import sqlite3, datetime, os, multiprocessing as mp, concurrent.futures
+import re, sqlite3, datetime, os, time, zlib, threading, queue, multiprocessing as mp, concurrent.futures, urllib.request
 from pathlib import Path
 
 import click
-import pandas as pd
 import SimpleITK as sitk
 import pydicom
 from tqdm import tqdm
 
-ifr = sitk.ImageFileReader()
-ifr.LoadPrivateTagsOn()
-
-dcm_tags = {  # Attributes
-    "0008|0005": "SpecificCharacterSet",
-    "0008|0008": "ImageType",
-    "0008|0012": "InstanceCreationDate",
-    "0008|0013": "InstanceCreationTime",
-    "0008|0016": "SOPClassUID",
-    "0008|0018": "SOPInstanceUID",
-    "0008|0020": "StudyDate",
-    "0008|0021": "SeriesDate",
-    "0008|0022": "AcquisitionDate",
-    "0008|0023": "ContentDate",
-    "0008|0030": "StudyTime",
-    "0008|0031": "SeriesTime",
-    "0008|0032": "AcquisitionTime",
-    "0008|0033": "ContentTime",
-    "0008|0050": "AccessionNumber",
-    "0008|0060": "Modality",
-    "0008|0070": "Manufacturer",
-    "0008|1010": "StationName",
-    "0008|1030": "StudyDescription",
-    "0008|103e": "SeriesDescription",
-    "0008|1040": "InstitutionalDepartmentName",
-    "0008|1090": "ManufacturersModelName",
-    "0010|0020": "PatientID",
-    "0010|0030": "PatientsBirthDate",
-    "0010|0040": "PatientsSex",
-    "0010|1010": "PatientsAge",
-    "0010|21b0": "AdditionalPatientHistory",
-    "0012|0062": "PatientIdentityRemoved",
-    "0012|0063": "DeidentificationMethod",
-    "0018|0015": "BodyPartExamined",
-    "0018|0020": "ScanningSequence",
-    "0018|0021": "SequenceVariant",
-    "0018|0022": "ScanOptions",
-    "0018|0023": "MRAcquisitionType",
-    "0018|0024": "SequenceName",
-    "0018|0050": "SliceThickness",
-    "0018|0080": "RepetitionTime",
-    "0018|0081": "EchoTime",
-    "0018|0083": "NumberofAverages",
-    "0018|0084": "ImagingFrequency",
-    "0018|0085": "ImagedNucleus",
-    "0018|0087": "MagneticFieldStrength",
-    "0018|0088": "SpacingBetweenSlices",
-    "0018|0089": "NumberofPhaseEncodingSteps",
-    "0018|0091": "EchoTrainLength",
-    "0018|0093": "PercentSampling",
-    "0018|0094": "PercentPhaseFieldofView",
-    "0018|1000": "DeviceSerialNumber",
-    "0018|1030": "ProtocolName",
-    "0018|1310": "AcquisitionMatrix",
-    "0018|1312": "InplanePhaseEncodingDirection",
-    "0018|1314": "FlipAngle",
-    "0018|1315": "VariableFlipAngleFlag",
-    "0018|5100": "PatientPosition",
-    "0018|9087": "Diffusionbvalue",
-    "0020|000d": "StudyInstanceUID",
-    "0020|000e": "SeriesInstanceUID",
-    "0020|0010": "StudyID",
-    "0020|0032": "ImagePositionPatient",
-    "0020|0037": "ImageOrientationPatient",
-    "0020|0052": "FrameofReferenceUID",
-    "0020|1041": "SliceLocation",
-    "0028|0002": "SamplesperPixel",
-    "0028|0010": "Rows",
-    "0028|0011": "Columns",
-    "0028|0030": "PixelSpacing",
-    "0028|0100": "BitsAllocated",
-    "0028|0101": "BitsStored",
-    "0028|0106": "SmallestImagePixelValue",
-    "0028|0107": "LargestImagePixelValue",
-    "0028|1050": "WindowCenter",
-    "0028|1051": "WindowWidth",
-    "0040|0244": "PerformedProcedureStepStartDate",
-    "0040|0254": "PerformedProcedureStepDescription"
-}
+from dataviewer import pixels
+from dataviewer.stats import Stats
+from dataviewer.tags import dcm_tags, TAGS, COLUMNS, COLUMN_TYPES, INDEXED, FULL_TEXT, INSTANCE_TAGS, \
+    INSTANCE_COLUMNS
 
 TABLE_DOSSIERS = "Dossiers"
 TABLE_PATH = "InputPath"
+TABLE_FINGERPRINTS = "Fingerprints"
+TABLE_JOURNAL = "Journal"
+TABLE_TEXT = "DossiersText"
+TABLE_THUMBNAILS = "Thumbnails"
+TABLE_INSTANCES = "Instances"
 ORDER_BY = "SeriesTime,StudyTime,StudyInstanceUID,SeriesInstanceUID,PatientID"
+CHUNK_SIZE = 16
+FETCH_SIZE = 1024
+COMPARISONS = ['>=', '<=', '!=', '>', '<']
+QUEUE_SIZE = 4096
+BATCH_SIZE = 256
+COMMIT_SIZE = 4096
+PRAGMAS = ['journal_mode=WAL', 'synchronous=NORMAL', 'temp_store=MEMORY', 'cache_size=-65536']
+
+_local = threading.local()
+
+
+def image_file_reader() -> sitk.ImageFileReader:
+    # SimpleITK readers are not thread-safe, every thread (and every worker process) owns its own
+    if not hasattr(_local, 'ifr'):
+        _local.ifr = sitk.ImageFileReader()
+        _local.ifr.LoadPrivateTagsOn()
+    return _local.ifr
+
+
+def read_header(path) -> pydicom.dataset.FileDataset:
+    # stop before pixel data and skip over every element not in dcm_tags
+    return pydicom.dcmread(path, stop_before_pixels=True, specific_tags=TAGS)
+
+
+def to_value(val, type: str = 'TEXT'):
+    """Converts a pydicom or SimpleITK (backslash separated) value to the given column type."""
+    if val is None or isinstance(val, bytes):
+        return None
+    values = list(val) if isinstance(val, (list, pydicom.multival.MultiValue)) else str(val).split('\\')
+    values = [str(v).strip() for v in values]
+    if not any(values):
+        return None
+    if type == 'REAL':
+        return float(values[0])
+    if type == 'INTEGER':
+        return int(float(values[0]))
+    if type == 'DATE':
+        return datetime.datetime.strptime(values[0][:8], '%Y%m%d').date().isoformat()
+    return '\\'.join(values)
+
+
+def parse_value(value: str, type: str = 'TEXT'):
+    """Converts a --select value to the given column type, dates may be given as YYYY-MM-DD or YYYYMMDD."""
+    value = value.strip()
+    if type == 'REAL':
+        return float(value)
+    if type == 'INTEGER':
+        return int(float(value))
+    if type == 'DATE':
+        return datetime.date.fromisoformat(value).isoformat() if '-' in value else to_value(value, type)
+    return value
+
+
+def parse_selection(value: str):
+    """Splits a --select item into (key, value), keeping comparisons in the value, e.g. EchoTime>80 is (EchoTime, >80)."""
+    if not (match := re.match(r'^(\w+)\s*(>=|<=|!=|>|<|=)(.*)$', value.strip())):
+        raise ValueError("no '=' or comparison found")
+    k, op, v = match.groups()
+    if len(v.strip()) == 0:
+        raise ValueError("empty value")
+    if k not in dcm_tags.values():
+        raise ValueError(f"invalid key {k}")
+    if op != '=' and COLUMN_TYPES[k] == 'TEXT':
+        raise ValueError("comparisons require a numeric or date key")
+    v = v if op == '=' else op + v
+    if (type := COLUMN_TYPES[k]) != 'TEXT':
+        # fail here rather than in the query, with the same rules as Connection._where
+        for alternative in v.split(','):
+            if (c := next((c for c in COMPARISONS if alternative.startswith(c)), None)) is not None:
+                bounds = [alternative[len(c):]]
+            elif '..' in alternative:
+                bounds = [b for b in alternative.split('..', maxsplit=1) if b.strip()]
+                if not bounds:
+                    raise ValueError(f"range {alternative} of {k} needs at least one bound")
+            else:
+                bounds = [alternative]
+            for bound in bounds:
+                try:
+                    if parse_value(bound, type) is None:
+                        raise ValueError
+                except ValueError:
+                    raise ValueError(f"{bound.strip() or 'empty value'} is not a valid {type.lower()} for {k}") from None
+    return k, v
 
 
 def get_pydicom_value(data: pydicom.dataset.FileDataset, key: str):
@@ -100,167 +112,721 @@ def get_pydicom_value(data: pydicom.dataset.FileDataset, key: str):
     return None
 
 
+def read_only_uri(path):
+    # no authority, Path.as_uri() turns UNC paths into file://server/share which SQLite refuses
+    return 'file:' + urllib.request.pathname2url(os.path.abspath(path)) + '?mode=ro'
+
+
 class Connection:
     def __init__(self, path):
-        self._conn = sqlite3.connect(os.path.abspath(path))
-        self._c = self._conn.cursor()
+        # read-only, so selections work on shared or write-protected copies without taking write locks
+        # shared by the viewer's threads, so every query runs on its own cursor
+        self._conn = sqlite3.connect(read_only_uri(path), uri=True, check_same_thread=False)
+        self.path = path
         self.name = path.name
 
     def __del__(self):
         self._conn.close()
 
-    def _refactor_result(self, results: list):
-        desc = self._c.description
-        R = []
-        for r in results:
-            item = dict()
-            for i, name in enumerate(desc):
-                item[name[0]] = r[i]
-            R.append(item)
-        return R
+    def interrupt(self):
+        # safe to call from any thread, the running query raises sqlite3.OperationalError
+        self._conn.interrupt()
 
-    def select(self, include_siblings=True, **kvp):
-        q = []
+    def _iterate(self, Q: str, params=(), chunk_size: int = FETCH_SIZE):
+        # every iterator gets its own cursor, rows are fetched and yielded in chunks of sqlite3.Row
+        c = self._conn.cursor()
+        c.row_factory = sqlite3.Row
+        try:
+            c.execute(Q, params)
+            while rows := c.fetchmany(chunk_size):
+                yield rows
+        finally:
+            c.close()
+
+    def _select_query(self, kvp: dict, include_siblings=True, columns: list = None, within: dict = None,
+                      order=True):
+        # within restricts the outer query to exact column values, e.g. the series of a single study
+        # queries wrapped in an aggregate are not ordered, sorting them first would only be wasted work
+        within = within or {}
+        # names are interpolated into the query, values are bound
+        if invalid := [c for c in (columns or []) if c not in COLUMNS and c != 'index'] + [k for k in within if k not in COLUMNS]:
+            raise KeyError(f"Invalid column {invalid[0]}")
+        columns = ', '.join(f'[{c}]' for c in columns) if columns else '*'
+        restrict = [f"{k} IS ?" for k in within]
+        order_by = f" ORDER BY {ORDER_BY}" if order else ''
+
+        if not kvp:
+            where = f" WHERE {' AND '.join(restrict)}" if restrict else ''
+            return f"SELECT rowid, {columns}, 0 AS Selected FROM {TABLE_DOSSIERS}{where}{order_by}", list(within.values())
+
+        where, params = self._where(kvp)
+        # a single read-only statement, siblings are the other series of selected studies
+        Q = f"WITH selected AS (SELECT rowid FROM {TABLE_DOSSIERS} WHERE {where}) " \
+            f"SELECT rowid, {columns}, rowid IN selected AS Selected FROM {TABLE_DOSSIERS} WHERE "
+        if include_siblings:
+            restrict.append(f"StudyInstanceUID IN (SELECT StudyInstanceUID FROM {TABLE_DOSSIERS} WHERE rowid IN selected)")
+        else:
+            restrict.append("rowid IN selected")
+        Q += f"{' AND '.join(restrict)}{order_by}"
+        return Q, params + list(within.values())
+
+    def _has_table(self, table: str):
+        return self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone() is not None
+
+    def _where(self, kvp: dict):
+        """
+        Values are comma separated alternatives. Typed (REAL, INTEGER, DATE) columns accept comparisons
+        (>80, <=2020-01-01) and inclusive ranges (80..120, 2020-01-01.., ..120) besides exact values.
+        """
+        q, params = [], []
+        full_text = self._has_table(TABLE_TEXT)
         for key, value in kvp.items():
-            values = value.split(',')
-            values = [f"{key} LIKE '%{v}%'" for v in values]
-            values = ' OR '.join(values)
-            q.append(f"({values})")
-        selection = 'StudyInstanceUID,SeriesInstanceUID' if include_siblings else '*'
-        Q = f"SELECT {selection} FROM {TABLE_DOSSIERS} WHERE {' AND '.join(q)} ORDER BY {ORDER_BY}"
-
-        # studies can be duplicate (set), series should be unique (list)
-        studies, series = set(), []
-        for study, serie in self._c.execute(Q).fetchall():
-            studies.add(study)
-            series.append(serie)
-
-        temp = 'TEMP'
-        df = pd.DataFrame.from_records([{'uid': u} for u in studies])
-        df.to_sql(name=temp, con=self._conn, if_exists='replace')
-
-        R = self._c.execute(f"SELECT * FROM {TABLE_DOSSIERS} orig, {temp} t WHERE t.uid = orig.StudyInstanceUID").fetchall()
-        R = self._refactor_result(R)
-
-        self._c.execute(f"DROP TABLE {temp}")
+            if key not in COLUMNS:
+                raise KeyError(f"Invalid key {key}")
+            values, type = value.split(','), COLUMN_TYPES[key]
+            if type != 'TEXT':
+                alternatives = []
+                for v in values:
+                    if (op := next((op for op in COMPARISONS if v.startswith(op)), None)) is not None:
+                        alternatives.append(f"{key} {op} ?")
+                        params.append(parse_value(v[len(op):], type))
+                    elif '..' in v:
+                        low, high = (b.strip() for b in v.split('..', maxsplit=1))
+                        bounds = [(f"{key} >= ?", low), (f"{key} <= ?", high)]
+                        alternatives.append(f"({' AND '.join(b for b, bound in bounds if bound)})")
+                        params += [parse_value(bound, type) for _, bound in bounds if bound]
+                    else:
+                        alternatives.append(f"{key} = ?")
+                        params.append(parse_value(v, type))
+                q.append(f"({' OR '.join(alternatives)})")
+            elif key in INDEXED:
+                # exact but case-insensitive, served by the NOCASE index
+                q.append(f"{key} COLLATE NOCASE IN ({','.join('?' * len(values))})")
+                params += values
+            elif key in FULL_TEXT and full_text and all(len(v) >= 3 for v in values):
+                # trigrams match substrings case-insensitively, like LIKE '%v%' would
+                match = ' OR '.join('"' + v.replace('"', '""') + '"' for v in values)
+                q.append(f"rowid IN (SELECT rowid FROM {TABLE_TEXT} WHERE {TABLE_TEXT} MATCH ?)")
+                params.append(f"{key} : ({match})")
+            else:
+                q.append(f"({' OR '.join(f'{key} LIKE ?' for _ in values)})")
+                params += [f'%{v}%' for v in values]
+        return ' AND '.join(q), params
+
+    def iterate_select(self, include_siblings=True, columns: list = None, chunk_size: int = FETCH_SIZE,
+                       within: dict = None, **kvp):
+        """
+        Yields chunks of sqlite3.Row (rowid, columns..., Selected), without ever holding the whole result in memory.
+        Selected flags the rows matching the selection, as opposed to their siblings.
+        """
+        return self._iterate(*self._select_query(kvp, include_siblings, columns, within), chunk_size)
+
+    def iterate_all(self, columns: list = None, chunk_size: int = FETCH_SIZE):
+        return self.iterate_select(columns=columns, chunk_size=chunk_size)
+
+    def iterate_patients(self, include_siblings=True, chunk_size: int = FETCH_SIZE, **kvp):
+        """Yields chunks of (PatientID, Studies, Series, Selected) rows, counting the series in the selection."""
+        Q, params = self._select_query(kvp, include_siblings, ['PatientID', 'StudyInstanceUID'], order=False)
+        return self._iterate(f"SELECT PatientID, COUNT(DISTINCT StudyInstanceUID) AS Studies, COUNT(*) AS Series, "
+                             f"SUM(Selected) AS Selected FROM ({Q}) GROUP BY PatientID ORDER BY PatientID",
+                             params, chunk_size)
+
+    def iterate_studies(self, patient_id, include_siblings=True, chunk_size: int = FETCH_SIZE, **kvp):
+        """Yields chunks of (StudyInstanceUID, index, StudyDescription, Series, Selected) rows of a single patient."""
+        columns = ['index', 'StudyInstanceUID', 'StudyDescription', 'StudyDate', 'StudyTime']
+        Q, params = self._select_query(kvp, include_siblings, columns, {'PatientID': patient_id}, order=False)
+        return self._iterate(f"SELECT StudyInstanceUID, MIN([index]) AS [index], MIN(StudyDescription) AS StudyDescription, "
+                             f"COUNT(*) AS Series, SUM(Selected) AS Selected FROM ({Q}) "
+                             f"GROUP BY StudyInstanceUID ORDER BY MIN(StudyDate), MIN(StudyTime)", params, chunk_size)
+
+    def count(self, include_siblings=True, **kvp):
+        Q, params = self._select_query(kvp, include_siblings, ['index'], order=False)
+        return self._conn.execute(f"SELECT COUNT(*) FROM ({Q})", params).fetchone()[0]
+
+    def input(self):
+        """Returns the directory the database was created from, or None."""
+        if self._has_table(TABLE_PATH) and (row := self._conn.execute(f"SELECT Input FROM {TABLE_PATH}").fetchone()):
+            return row[0]
+
+    def thumbnail(self, path: str):
+        """Returns the uint8 (rows, columns, samples) thumbnail of a dossier, or None."""
+        if self._has_table(TABLE_THUMBNAILS):
+            if row := self._conn.execute(f"SELECT Rows, Columns, Data FROM {TABLE_THUMBNAILS} WHERE Path = ?", (path,)).fetchone():
+                return pixels.decode_thumbnail(*row)
+
+    def instances(self, path: str):
+        """Returns the Instances rows of a dossier ordered by InstanceNumber, empty if they were not stored."""
+        if self._has_table(TABLE_INSTANCES):
+            Q = f"SELECT * FROM {TABLE_INSTANCES} WHERE Path = ? ORDER BY InstanceNumber, File"
+            return [row for rows in self._iterate(Q, (path,)) for row in rows]
+        return []
+
+    def get(self, rowid: int):
+        for rows in self._iterate(f"SELECT * FROM {TABLE_DOSSIERS} WHERE rowid = ?", (rowid,)):
+            return rows[0]
+        raise LookupError(f"No row {rowid} in {TABLE_DOSSIERS}")
 
+    def select(self, include_siblings=True, **kvp):
+        R, series = [], []
+        for rows in self.iterate_select(include_siblings, **kvp):
+            for row in rows:
+                item = dict(row)
+                if item.pop('Selected'):
+                    series.append(item['SeriesInstanceUID'])
+                R.append(item)
         return R, series
 
     def select_all(self):
-        Q = f"SELECT * FROM {TABLE_DOSSIERS} ORDER BY {ORDER_BY}"
-        return self._refactor_result(self._c.execute(Q).fetchall())
+        return self.select()[0]
 
 
 class Dossier:
-    def __init__(self, input_dir: Path, dcm_dir: Path, dcms: list):
+    def __init__(self, input_dir: Path, dcm_dir: Path, dcms: list, fingerprint: tuple = None):
+        self.input_dir = input_dir
         self.dcm_dir = dcm_dir
         self.sample = dcms[-1]
         self.sample_path = str(input_dir / dcm_dir / self.sample)
         self.dcms = dcms
-        self._headers = None
+        self.error = None
+        self.files_read = 0  # opened by the reads below, a header read opens only the sample
+        self.bytes_read = 0  # up to where reading stopped, e.g. before pixel data
+        self._row = None
+        self._fingerprint = fingerprint
 
     def __len__(self):
         return len(self.dcms)
 
+    @property
+    def fingerprint(self):
+        # (file count, newest mtime, total size), cheap to compute compared to reading headers
+        if not self._fingerprint:
+            mtime, size = 0., 0
+            for dcm in self.dcms:
+                stat = os.stat(os.path.join(self.input_dir, self.dcm_dir, dcm))
+                mtime, size = max(mtime, stat.st_mtime), size + stat.st_size
+            self._fingerprint = len(self), mtime, size
+        return self._fingerprint
+
     def is_valid(self):
+        # validation shares the single header read with extraction
+        return self.row is not None
+
+    def thumbnail(self, size: int):
+        """Returns (rows, columns, data) of a window-levelled 8-bit thumbnail of the sample, or None."""
         try:
-            pydicom.dcmread(self.sample_path, specific_tags=['0x00080005'])
-        except:
+            img, slope, intercept = pixels.read_pixels(self.sample_path)
+            self.bytes_read += os.path.getsize(self.sample_path)
+            headers = self.headers
+            img = pixels.window_level(pixels.downsample(img, size), headers['WindowCenter'], headers['WindowWidth'],
+                                      slope, intercept)
+            return pixels.encode_thumbnail(img)
+        except Exception:
+            return None
+
+    def instances(self):
+        """Returns an INSTANCE_COLUMNS tuple for every readable file, reading only the INSTANCE_TAGS of each."""
+        instances = []
+        for dcm in self.dcms:
+            path = os.path.join(self.input_dir, self.dcm_dir, dcm)
             try:
-                ifr.SetFileName(self.sample_path)
-                ifr.ReadImageInformation()
-            except:
-                return False
-        return True
+                with open(path, 'rb') as f:
+                    data = pydicom.dcmread(f, stop_before_pixels=True, specific_tags=list(INSTANCE_TAGS))
+                    # the sample was opened for its header already
+                    self.files_read, self.bytes_read = self.files_read + (dcm != self.sample), self.bytes_read + f.tell()
+                values = [to_value(data[tag].value if tag in data else None, 'INTEGER' if name == 'InstanceNumber' else 'TEXT')
+                          for tag, name in INSTANCE_TAGS.items()]
+                instances.append((str(self.dcm_dir), dcm, *values, os.path.getsize(path)))
+            except Exception:
+                continue
+        return instances
+
+    @property
+    def row(self):
+        if not self._row:
+            self._row = self._dossier_to_row()
+        return self._row
 
     @property
     def headers(self):
-        if not self._headers:
-            self._headers = self._dossier_to_row()
-        return self._headers
+        return dict(zip(COLUMNS, self.row)) if self.row else None
 
     def _dossier_to_row(self):
+        self.files_read += 1
         try:
-            dcm = pydicom.dcmread(self.sample_path)
+            with open(self.sample_path, 'rb') as f:
+                dcm = read_header(f)
+                self.bytes_read += f.tell()
             get_metadata = lambda key: get_pydicom_value(dcm, key)
         except:
             try:
+                ifr = image_file_reader()
                 ifr.SetFileName(self.sample_path)
                 ifr.ReadImageInformation()
+                # SimpleITK does not tell how far it read, count the whole file
+                self.bytes_read += os.path.getsize(self.sample_path)
                 get_metadata = lambda key: ifr.GetMetaData(key)
             except Exception as e:
                 print(f"EXCEPTION (skipping): {self.dcm_dir}")
                 print(e)
+                self.error = type(e).__name__
                 return None
 
-        headers = {'SeriesLength': len(self), 'Path': str(self.dcm_dir), 'Sample': self.sample}
-        for key, header in dcm_tags.items():
+        row = [len(self), str(self.dcm_dir), self.sample]
+        for key, header in zip(dcm_tags, COLUMNS[3:]):
             try:
-                header = header.replace(' ', '_').strip()
-                val = get_metadata(key)
-                try:
-                    if 'Date' in header:
-                        val = datetime.datetime(int(val[:4]), int(val[4:6]), int(val[6:]))
-                    # if 'Time' in header:
-                    #     return f'{val[0:2]}:{val[2:4]}:{val[4:6]}.{int(val[7:])}'
-                finally:
-                    val = val.strip()
-                headers[header] = val
+                row.append(to_value(get_metadata(key), COLUMN_TYPES[header]))
             except:
-                headers[header] = None
+                row.append(None)
 
-        return headers
+        return tuple(row)
 
-# def header_to_date(header):
-#     header = str(header)
-#     return datetime.datetime(int(header[:4]), int(header[4:6]), int(header[6:]))
 
+def in_shard(name: str, shard: tuple = None):
+    # stable across machines and runs, unlike hash()
+    return shard is None or zlib.crc32(name.encode()) % shard[1] == shard[0] - 1
 
-def create(input: Path, output: Path):
-    try:
-        sqlite3.connect(output).close()
-
-        click.echo(f"Gathering DICOMs from {input} and its subdirectories")
 
-        dcms = dict()
-        dirs = os.listdir(input)
+def walk(input: Path, workers: int = None, stats: Stats = None, shard: tuple = None):
+    """
+    Yields a Dossier for every directory containing DICOMs, as soon as it is listed.
+    Top-level directories are walked concurrently using os.scandir, which also provides the fingerprints.
+    With a (K, N) shard, only the top-level directories of the K-th of N shares are walked.
+    """
+    click.echo(f"Gathering DICOMs from {input} and its subdirectories")
+    stats = stats or Stats()
+    stats.start('walk')
 
-        def walk_input(dir: Path):
-            for dirpath, dirnames, filenames in os.walk(input / dir):
-                for filename in [f for f in filenames if f.endswith(".dcm")]:
-                    dpath = str(Path(dirpath).relative_to(input))
-                    dcms[dpath] = dcms.get(dpath, []) + [filename]
+    found = queue.Queue(maxsize=QUEUE_SIZE)
+    stop = threading.Event()
 
-        with concurrent.futures.ThreadPoolExecutor(min(32, (os.cpu_count() or 1) + 4)) as executor:
-            list(tqdm(executor.map(walk_input, dirs), total=len(dirs)))
-
-        # Create Dossier items
-        dossiers = []
-        for subpath, filenames in dcms.items():
-            dossiers.append(Dossier(input, subpath, filenames))
+    def put(item):
+        while not stop.is_set():
+            try:
+                return found.put(item, timeout=.1)
+            except queue.Full:
+                pass
+
+    def scan(dir: str):
+        stack = [dir]
+        while stack and not stop.is_set():
+            dirpath, dcms, mtime, size = stack.pop(), [], 0., 0
+            try:
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        # like os.walk, never descend into linked directories, they may point back up the tree
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.name.endswith('.dcm'):
+                            stat = entry.stat()
+                            dcms.append(entry.name)
+                            mtime, size = max(mtime, stat.st_mtime), size + stat.st_size
+            except OSError as e:
+                stats.fail('walk', type(e).__name__)
+                continue
+            if dcms:
+                stats.add('walk', dossiers=1, files=len(dcms), bytes=size)
+                put(Dossier(input, os.path.relpath(dirpath, input), dcms, (len(dcms), mtime, size)))
+
+    def scan_all():
+        try:
+            dirs = [entry.path for entry in os.scandir(input) if entry.is_dir(follow_symlinks=False) and in_shard(entry.name, shard)]
+            with concurrent.futures.ThreadPoolExecutor(workers or min(32, (os.cpu_count() or 1) + 4)) as executor:
+                list(executor.map(scan, dirs))
+        finally:
+            stats.stop('walk')
+            put(None)
+
+    def dossiers():
+        try:
+            while (dossier := found.get()) is not None:
+                yield dossier
+        finally:
+            stop.set()
+
+    threading.Thread(target=scan_all, daemon=True).start()
+    return dossiers()
+
+
+def process_chunk(dossiers: list, thumbnails: int = None, instances: bool = False):
+    # runs inside a worker, return compact tuples rather than Dossiers or dicts
+    start, results, errors, files, size = time.perf_counter(), [], [], 0, 0
+    for d in dossiers:
+        row = d.row
+        thumbnail = d.thumbnail(thumbnails) if row and thumbnails else None
+        results.append((str(d.dcm_dir), row, d.fingerprint if row else None, thumbnail,
+                        d.instances() if row and instances else None))
+        if d.error:
+            errors.append(d.error)
+        files, size = files + d.files_read, size + d.bytes_read
+    worker = f'{os.getpid()}:{threading.current_thread().name}'
+    return results, worker, time.perf_counter() - start, errors, files, size
+
+
+def process(dossiers, sink, workers: int = None, executor: str = 'process', thumbnails: int = None, stats: Stats = None,
+            instances: bool = False):
+    """
+    Reads the headers of an iterable of Dossiers in chunks, passing (path, row, fingerprint, thumbnail, instances) items
+    to sink. Chunks are dispatched as soon as they fill up, so reading overlaps with walking the input.
+    Thumbnails of at most this size are only created if given, instances are only read from every file if asked.
+    """
+    stats = stats or Stats()
+    stats.start('read')
+    if executor == 'process':
+        workers = workers or os.cpu_count() or 1
+        # never fork, the walker and writer threads are already running
+        context = mp.get_context('forkserver' if 'forkserver' in mp.get_all_start_methods() else 'spawn')
+        pool = concurrent.futures.ProcessPoolExecutor(workers, mp_context=context)
+    else:
+        workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+
+    with pool, tqdm(total=0, unit='files') as progress:
+        pending = dict()  # future: files in the directories of its chunk
+
+        def submit(chunk):
+            files = sum(len(d) for d in chunk)
+            pending[pool.submit(process_chunk, chunk, thumbnails, instances)] = files
+            progress.total += files
+            progress.refresh()
+
+        def consume(return_when):
+            done, _ = concurrent.futures.wait(pending, return_when=return_when)
+            for future in done:
+                results, worker, busy, errors, read, size = future.result()
+                [sink(*result) for result in results]
+                # the files and bytes actually read, not the size of the directories
+                stats.add('read', dossiers=len(results), files=read, bytes=size, busy=busy, worker=worker)
+                [stats.fail('read', e) for e in errors]
+                progress.update(pending.pop(future))
+
+        # keep a bounded number of chunks in flight, so results never pile up in memory
+        chunk = []
+        for dossier in dossiers:
+            chunk.append(dossier)
+            if len(chunk) >= CHUNK_SIZE:
+                if len(pending) >= workers * 2:
+                    consume(concurrent.futures.FIRST_COMPLETED)
+                submit(chunk)
+                chunk = []
+        if chunk:
+            submit(chunk)
+        consume(concurrent.futures.ALL_COMPLETED)
+    stats.stop('read')
+
+
+def connect(path, timeout=60):
+    conn = sqlite3.connect(path, timeout=timeout)
+    [conn.execute(f"PRAGMA {pragma}") for pragma in PRAGMAS]
+    return conn
+
+
+def column_type(column: str):
+    # indexed text columns compare case-insensitively, so their single index serves selections and tree queries alike
+    return COLUMN_TYPES[column] + (' COLLATE NOCASE' if column in INDEXED and COLUMN_TYPES[column] == 'TEXT' else '')
+
+
+def create_tables(conn: sqlite3.Connection):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_PATH} ([index] INTEGER, Input TEXT)")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_DOSSIERS} "
+                 f"([index] INTEGER, {', '.join(f'[{c}] {column_type(c)}' for c in COLUMNS)})")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_FINGERPRINTS} "
+                 f"(Path TEXT PRIMARY KEY, Files INTEGER, MTime REAL, Size INTEGER)")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_THUMBNAILS} "
+                 f"(Path TEXT PRIMARY KEY, Rows INTEGER, Columns INTEGER, Data BLOB)")
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {TABLE_INSTANCES} "
+                 f"(Path TEXT, File TEXT, SOPInstanceUID TEXT, SeriesInstanceUID TEXT, InstanceNumber INTEGER, "
+                 f"ImagePositionPatient TEXT, AcquisitionTime TEXT, Size INTEGER, PRIMARY KEY (Path, File))")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_DOSSIERS}_Path ON {TABLE_DOSSIERS} (Path)")
+
+
+def create_indexes(conn: sqlite3.Connection):
+    """
+    Indexes are built once after bulk writes, maintaining them during inserts is much slower. The full-text table is
+    only built if it does not exist yet, triggers keep it up to date with every later write, e.g. by update.
+    """
+    schema = conn.execute("SELECT sql FROM sqlite_master WHERE name = ?", (TABLE_DOSSIERS,)).fetchone()[0]
+    for column in INDEXED:
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_DOSSIERS}_{column} ON {TABLE_DOSSIERS} ({column})")
+        if column_type(column) != COLUMN_TYPES[column] and f'[{column}] {column_type(column)}' not in schema:
+            # a database created before these columns were case-insensitive
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_DOSSIERS}_{column}_nocase "
+                         f"ON {TABLE_DOSSIERS} ({column} COLLATE NOCASE)")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLE_INSTANCES}_SOPInstanceUID ON {TABLE_INSTANCES} (SOPInstanceUID)")
+    try:
+        triggers = {t for t, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")}
+        if not {f'{TABLE_TEXT}_insert', f'{TABLE_TEXT}_delete'} <= triggers or \
+                not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (TABLE_TEXT,)).fetchone():
+            conn.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE_TEXT} USING fts5({', '.join(FULL_TEXT)}, "
+                         f"content='{TABLE_DOSSIERS}', content_rowid='rowid', tokenize='trigram')")
+            conn.execute(f"INSERT INTO {TABLE_TEXT}({TABLE_TEXT}) VALUES ('rebuild')")
+            # the Writer only inserts and deletes rows, upserts delete before inserting
+            columns, new, old = ', '.join(FULL_TEXT), ', '.join(f'new.{c}' for c in FULL_TEXT), \
+                ', '.join(f'old.{c}' for c in FULL_TEXT)
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS {TABLE_TEXT}_insert AFTER INSERT ON {TABLE_DOSSIERS} BEGIN "
+                         f"INSERT INTO {TABLE_TEXT}(rowid, {columns}) VALUES (new.rowid, {new}); END")
+            conn.execute(f"CREATE TRIGGER IF NOT EXISTS {TABLE_TEXT}_delete AFTER DELETE ON {TABLE_DOSSIERS} BEGIN "
+                         f"INSERT INTO {TABLE_TEXT}({TABLE_TEXT}, rowid, {columns}) VALUES ('delete', old.rowid, {old}); END")
+    except sqlite3.OperationalError as e:
+        click.echo(f"Full-text search unavailable, falling back to LIKE selections ({e})")
+    conn.execute("PRAGMA optimize")
+
+
+class Writer(threading.Thread):
+    """
+    Consumes (path, row, fingerprint, thumbnail, instances) items from a bounded queue and writes them in executemany batches,
+    committing every commit_size dossiers. With upsert, existing rows of the same path are replaced (keeping their index)
+    and rows that failed to be read are deleted. With journal, every processed path is recorded in the same transaction.
+    """
+
+    def __init__(self, output: Path, upsert: bool = False, journal: bool = False,
+                 batch_size: int = BATCH_SIZE, commit_size: int = COMMIT_SIZE, stats: Stats = None):
+        super().__init__(daemon=True)
+        self.stats = stats or Stats()
+        self.output = output
+        self.upsert = upsert
+        self.journal = journal
+        self.batch_size = min(batch_size, commit_size)
+        self.commit_size = commit_size
+        self.queue = queue.Queue(maxsize=QUEUE_SIZE)
+        self.written = 0
+        self.error = None
+
+    def put(self, path: str, row: tuple, fingerprint: tuple, thumbnail: tuple = None, instances: list = None):
+        if self.error:
+            raise self.error
+        self.queue.put((path, row, fingerprint, thumbnail, instances))
+
+    def close(self):
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+        return self.written
+
+    def run(self):
+        self.stats.start('write')
+        conn = connect(self.output)
+        try:
+            insert = f"INSERT INTO {TABLE_DOSSIERS} ([index], {', '.join(f'[{c}]' for c in COLUMNS)}) " \
+                     f"VALUES ({', '.join('?' * (len(COLUMNS) + 1))})"
+            next_index = conn.execute(f"SELECT IFNULL(MAX([index]) + 1, 0) FROM {TABLE_DOSSIERS}").fetchone()[0]
+            batch, uncommitted, done = [], 0, False
+
+            while not done:
+                if (item := self.queue.get()) is None:
+                    done = True
+                else:
+                    batch.append(item)
+                if len(batch) >= self.batch_size or (done and batch):
+                    start = time.perf_counter()
+                    rows, fingerprints, thumbnails, instances, removed = [], [], [], [], []
+                    for path, row, fingerprint, thumbnail, files in batch:
+                        index = None
+                        if self.upsert:
+                            removed.append((path,))
+                            index = conn.execute(f"SELECT [index] FROM {TABLE_DOSSIERS} WHERE Path = ?", (path,)).fetchone()
+                        if row:
+                            if index is None:
+                                index, next_index = (next_index,), next_index + 1
+                            rows.append((index[0], *row))
+                            fingerprints.append((path, *fingerprint))
+                        if thumbnail:
+                            thumbnails.append((path, *thumbnail))
+                        instances += files or []
+                    for table in [TABLE_DOSSIERS, TABLE_FINGERPRINTS, TABLE_THUMBNAILS, TABLE_INSTANCES]:
+                        conn.executemany(f"DELETE FROM {table} WHERE Path = ?", removed)
+                    conn.executemany(insert, rows)
+                    conn.executemany(f"INSERT OR REPLACE INTO {TABLE_FINGERPRINTS} VALUES (?, ?, ?, ?)", fingerprints)
+                    conn.executemany(f"INSERT OR REPLACE INTO {TABLE_THUMBNAILS} VALUES (?, ?, ?, ?)", thumbnails)
+                    conn.executemany(f"INSERT OR REPLACE INTO {TABLE_INSTANCES} VALUES ({', '.join('?' * len(INSTANCE_COLUMNS))})",
+                                     instances)
+                    if self.journal:
+                        conn.executemany(f"INSERT OR IGNORE INTO {TABLE_JOURNAL} VALUES (?)", [(item[0],) for item in batch])
+                    self.written += len(rows)
+                    uncommitted += len(batch)
+                    self.stats.add('write', dossiers=len(rows), busy=time.perf_counter() - start, worker='writer')
+                    batch = []
+                if uncommitted >= self.commit_size or done:
+                    start = time.perf_counter()
+                    conn.commit()
+                    uncommitted = 0
+                    self.stats.add('write', busy=time.perf_counter() - start, worker='writer')
+            # leave a self-contained database file behind, WAL does not work on network shares
+            conn.execute("PRAGMA journal_mode=DELETE")
+        except Exception as e:
+            self.error = e
+            self.stats.fail('write', type(e).__name__)
+            # earlier batches are committed, a partial one would leave rows without their journal entries
+            conn.rollback()
+            # unblock a producer waiting on a full queue
+            while not self.queue.empty():
+                self.queue.get_nowait()
+        finally:
+            conn.close()
+            self.stats.stop('write')
+
+
+def create(input: Path, output: Path, workers: int = None, executor: str = 'process',
+           resume: bool = False, checkpoint: int = COMMIT_SIZE, thumbnails: int = None, stats: Path = None,
+           instances: bool = False, shard: tuple = None):
+    """
+    Creates the database, printing a summary of every phase and writing it as a JSON report to stats if given.
+    With instances, the Instances table gets a row for every file besides the row per directory in Dossiers.
+    With a (K, N) shard, only part of the input is read, combine the databases of all N shards using merge.
+    """
+    collected = Stats(input=input, output=output, workers=workers, executor=executor, resume=resume, thumbnails=thumbnails,
+                      instances=instances, shard=shard)
+    try:
+        conn = sqlite3.connect(output, timeout=60)
+        tables = {t for t, in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+        if resume and TABLE_JOURNAL not in tables:
+            if TABLE_DOSSIERS in tables:
+                click.echo(f"Nothing to resume, {output} is complete")
+                return
+            resume = False
 
-        click.echo(f"Creating database from {len(dossiers)} DICOM directories")
+        with conn:
+            if resume:
+                db_input = conn.execute(f"SELECT Input FROM {TABLE_PATH}").fetchone()[0]
+                if db_input != str(input):
+                    raise ValueError(f"Cannot resume, {output} was created from {db_input}")
+            else:
+                [conn.execute(f"DROP TABLE IF EXISTS {t}") for t in [TABLE_PATH, TABLE_DOSSIERS, TABLE_FINGERPRINTS, TABLE_JOURNAL, TABLE_TEXT,
+                                                                      TABLE_THUMBNAILS, TABLE_INSTANCES]]
+                create_tables(conn)
+                conn.execute(f"CREATE TABLE {TABLE_JOURNAL} (Path TEXT PRIMARY KEY)")
+                conn.execute(f"INSERT INTO {TABLE_PATH} VALUES (0, ?)", (str(input),))
+        journal = {p for p, in conn.execute(f"SELECT Path FROM {TABLE_JOURNAL}")}
+        conn.close()
+
+        dossiers = walk(input, stats=collected, shard=shard)
+
+        if resume:
+            click.echo(f"Resuming, skipping {len(journal)} finished DICOM directories")
+            dossiers = (d for d in dossiers if d.dcm_dir not in journal)
+
+        (writer := Writer(output, journal=True, commit_size=checkpoint, stats=collected)).start()
+        try:
+            process(dossiers, writer.put, workers, executor, thumbnails, collected, instances)
+        finally:
+            written = writer.close()
 
-        rows = []
+        click.echo("Building indexes")
 
-        def process_dossier(dossier):
-            headers = dossier.headers
-            if headers:
-                rows.append(dossier.headers)
+        # a finished build needs no journal, its absence marks the database as complete
+        with collected.timed('indexes'), (conn := sqlite3.connect(output, timeout=60)):
+            create_indexes(conn)
+            conn.execute(f"DROP TABLE {TABLE_JOURNAL}")
+        conn.close()
 
-        with concurrent.futures.ThreadPoolExecutor(min(32, (os.cpu_count() or 1) + 4)) as executor:
-            list(tqdm(executor.map(process_dossier, dossiers), total=len(dossiers)))
+        click.echo(f"Wrote {written} rows to SQL database.")
+        click.echo(f"Database created at {os.path.join(os.getcwd(), output)}")
+    except Exception as e:
+        collected.fail('create', type(e).__name__)
+        click.echo(f'Error: {str(e)}')
+        click.echo("Finished DICOM directories are saved, continue using the 'new --resume' command")
+    finally:
+        if collected.phases:
+            click.echo(collected.summary())
+        if stats:
+            collected.write(stats)
+
+
+def update(input: Path, output: Path, workers: int = None, executor: str = 'process', thumbnails: int = None,
+           instances: bool = False):
+    try:
+        conn = sqlite3.connect(output, timeout=60)
+        if not conn.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (TABLE_DOSSIERS,)).fetchone():
+            raise LookupError(f"No {TABLE_DOSSIERS} table in {output}, create one using the 'new' command")
 
-        click.echo(f"Writing {len(rows)} rows to SQL database.")
+        with conn:
+            create_tables(conn)
+            conn.execute(f"UPDATE {TABLE_PATH} SET Input = ?", (str(input),))
+        known = {p: (f, m, s) for p, f, m, s in conn.execute(f"SELECT * FROM {TABLE_FINGERPRINTS}")}
+        indexed = {p for p, in conn.execute(f"SELECT Path FROM {TABLE_DOSSIERS}")}
+        # keep creating thumbnails of the size the database already has
+        thumbnails = thumbnails or conn.execute(f"SELECT MAX(MAX(Rows, Columns)) FROM {TABLE_THUMBNAILS}").fetchone()[0]
+        instances = instances or conn.execute(f"SELECT 1 FROM {TABLE_INSTANCES} LIMIT 1").fetchone() is not None
+        conn.close()
+
+        seen = set()
+
+        def changed():
+            for d in walk(input):
+                seen.add(d.dcm_dir)
+                if d.dcm_dir not in indexed or known.get(d.dcm_dir) != d.fingerprint:
+                    yield d
+
+        (writer := Writer(output, upsert=True)).start()
+        try:
+            process(changed(), writer.put, workers, executor, thumbnails, instances=instances)
+        finally:
+            written = writer.close()
+
+        vanished = [(p,) for p in indexed.difference(seen)]
+        with (conn := sqlite3.connect(output, timeout=60)):
+            for table in [TABLE_DOSSIERS, TABLE_FINGERPRINTS, TABLE_THUMBNAILS, TABLE_INSTANCES]:
+                conn.executemany(f"DELETE FROM {table} WHERE Path = ?", vanished)
+            create_indexes(conn)
+        conn.close()
+
+        click.echo(f"Updated {written} new or changed and removed {len(vanished)} vanished DICOM directories")
+        click.echo(f"Database updated at {output}")
+    except Exception as e:
+        click.echo(f'Error: {str(e)}')
 
-        df_dossiers = pd.DataFrame.from_dict(rows, orient='columns')
-        df_inputpath = pd.DataFrame({'Input': str(input)}, index=[0])
 
-        conn = sqlite3.connect(output, timeout=60)
+def merge(inputs: list, output: Path):
+    """
+    Combines databases created from the same input, e.g. by 'new --shard', into output. Every table is copied with
+    a single INSERT ... SELECT per database, the indexes are only built once everything is copied.
+    """
+    try:
+        sources = []
+        for path in inputs:
+            with sqlite3.connect(read_only_uri(path), uri=True) as conn:
+                tables = {t for t, in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")}
+                if TABLE_JOURNAL in tables or TABLE_DOSSIERS not in tables:
+                    raise ValueError(f"{path} is incomplete, finish it using the 'new --resume' command")
+                sources.append((path, tables, conn.execute(f"SELECT Input FROM {TABLE_PATH}").fetchone()[0]))
+            conn.close()
+        if len(inputs := {i for _, _, i in sources}) > 1:
+            raise ValueError(f"Cannot merge databases created from different directories: {', '.join(sorted(inputs))}")
+
+        if os.path.exists(output):
+            os.remove(output)
+        conn = connect(output)
+        create_tables(conn)
+        conn.execute(f"INSERT INTO {TABLE_PATH} VALUES (0, ?)", (inputs.pop(),))
+        conn.commit()
+
+        columns = ', '.join(f'[{c}]' for c in COLUMNS)
+        for path, tables, _ in tqdm(sources, unit='databases'):
+            conn.execute("ATTACH DATABASE ? AS source", (str(path),))
+            # shards must not overlap, Fingerprints and the others would silently keep one of the duplicates
+            if overlap := conn.execute(f"SELECT Path FROM source.{TABLE_DOSSIERS} "
+                                       f"WHERE Path IN (SELECT Path FROM main.{TABLE_DOSSIERS}) LIMIT 1").fetchone():
+                conn.close()
+                os.remove(output)
+                raise ValueError(f"Cannot merge {path}, {overlap[0]} is also in another of the databases")
+            with conn:
+                # indexes are unique within a database, offset them past the rows merged so far
+                offset = conn.execute(f"SELECT IFNULL(MAX([index]) + 1, 0) FROM {TABLE_DOSSIERS}").fetchone()[0]
+                conn.execute(f"INSERT INTO {TABLE_DOSSIERS} ([index], {columns}) "
+                             f"SELECT [index] + ?, {columns} FROM source.{TABLE_DOSSIERS}", (offset,))
+                for table in [TABLE_FINGERPRINTS, TABLE_THUMBNAILS, TABLE_INSTANCES]:
+                    if table in tables:
+                        conn.execute(f"INSERT OR REPLACE INTO {table} SELECT * FROM source.{table}")
+            conn.execute("DETACH DATABASE source")
+
+        click.echo("Building indexes")
         with conn:
-            df_inputpath.to_sql(name=TABLE_PATH, con=conn, if_exists='replace')
-            df_dossiers.to_sql(name=TABLE_DOSSIERS, con=conn, if_exists='replace')
+            create_indexes(conn)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        written = conn.execute(f"SELECT COUNT(*) FROM {TABLE_DOSSIERS}").fetchone()[0]
+        conn.close()
 
-        click.echo(f"Database created at {os.path.join(os.getcwd(), output)}")
+        click.echo(f"Merged {written} rows from {len(sources)} databases.")
+        click.echo(f"Database created at {output}")
     except Exception as e:
-        click.echo(f'Error: {str(e)}')
\ No newline at end of file
+        click.echo(f'Error: {str(e)}')
@@ -0,0 +1,54 @@
+import csv, json
+from pathlib import Path
+
+from dataviewer.db import Connection, COLUMNS, COLUMN_TYPES, FETCH_SIZE
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.parquet': 'parquet'}
+# rowid is internal to the database, Selected flags matches as opposed to their sibling series
+EXPORT_COLUMNS = ['index'] + COLUMNS + ['Selected']
+
+
+def write_csv(chunks, output: Path):
+    with open(output, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXPORT_COLUMNS)
+        for rows in chunks:
+            writer.writerows(rows)
+            yield len(rows)
+
+
+def write_jsonl(chunks, output: Path):
+    with open(output, 'w', encoding='utf-8') as f:
+        for rows in chunks:
+            f.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row))) + '\n' for row in rows)
+            yield len(rows)
+
+
+def write_parquet(chunks, output: Path):
+    try:
+        import pyarrow as pa, pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("Parquet export requires pyarrow, install it using 'pip install rumc-dataviewer[parquet]'")
+
+    # dates are stored as ISO 8601 text, and stay text
+    types = {'INTEGER': pa.int64(), 'REAL': pa.float64()}
+    schema = pa.schema([(c, types.get(COLUMN_TYPES.get(c, 'INTEGER'), pa.string())) for c in EXPORT_COLUMNS])
+    with pq.ParquetWriter(output, schema) as writer:
+        for rows in chunks:
+            # one row group per chunk
+            columns = list(zip(*rows))
+            writer.write_batch(pa.record_batch([pa.array(c, type=f.type) for c, f in zip(columns, schema)], schema=schema))
+            yield len(rows)
+
+
+def export(conn: Connection, output: Path, format: str = None, include_siblings=True, chunk_size: int = FETCH_SIZE,
+           **kvp):
+    """
+    Streams the rows of a selection to a CSV, JSON Lines or Parquet file chunk by chunk, straight from the cursor.
+    The format defaults to the file suffix. Yields the number of rows written per chunk.
+    """
+    format = format or FORMATS.get(output.suffix.lower())
+    if format not in FORMATS.values():
+        raise ValueError(f"Unknown export format {format or output.suffix}, expected one of {', '.join(FORMATS.values())}")
+    chunks = ([row[1:] for row in rows] for rows in conn.iterate_select(include_siblings, chunk_size=chunk_size, **kvp))
+    yield from {'csv': write_csv, 'jsonl': write_jsonl, 'parquet': write_parquet}[format](chunks, output)
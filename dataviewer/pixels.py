@@ -0,0 +1,125 @@
+import zlib, importlib, functools
+
+import numpy as np
+import pydicom
+import SimpleITK as sitk
+
+JPEG = ['pylibjpeg', 'gdcm', 'pillow', 'simpleitk']
+JPEG_LS = ['pylibjpeg', 'jpeg_ls', 'gdcm', 'simpleitk']
+# decoders to try per transfer syntax, fastest first: pydicom pixel data handlers and SimpleITK (GDCM)
+DECODERS = {
+    '1.2.840.10008.1.2.4.50': JPEG,  # JPEG Baseline
+    '1.2.840.10008.1.2.4.51': JPEG,  # JPEG Extended
+    '1.2.840.10008.1.2.4.57': JPEG,  # JPEG Lossless
+    '1.2.840.10008.1.2.4.70': JPEG,  # JPEG Lossless SV1
+    '1.2.840.10008.1.2.4.80': JPEG_LS,  # JPEG-LS Lossless
+    '1.2.840.10008.1.2.4.81': JPEG_LS,  # JPEG-LS Near Lossless
+    '1.2.840.10008.1.2.4.90': JPEG,  # JPEG 2000 Lossless
+    '1.2.840.10008.1.2.4.91': JPEG,  # JPEG 2000
+    '1.2.840.10008.1.2.5': ['pylibjpeg', 'gdcm', 'rle', 'simpleitk'],  # RLE Lossless
+}
+DEFAULT_DECODERS = ['numpy', 'gdcm', 'simpleitk']
+working_decoders = dict()  # transfer syntax: decoder that last succeeded, tried first
+
+
+@functools.lru_cache()
+def decoder_available(name: str):
+    if name == 'simpleitk':
+        return True
+    try:
+        return importlib.import_module(f'pydicom.pixel_data_handlers.{name}_handler').is_available()
+    except ImportError:
+        return False
+
+
+def decode(dcm: pydicom.Dataset, path: str, name: str):
+    """Returns the pixel array of dcm (frames first) decoded with the named decoder."""
+    if name == 'simpleitk':
+        img = sitk.GetArrayFromImage(sitk.ReadImage(path))
+        return img[0] if len(img) == 1 else img
+    dcm.convert_pixel_data(name)
+    return dcm.pixel_array
+
+
+def decoders(transfer_syntax: str):
+    """Available decoders for a transfer syntax, the one that worked last time first."""
+    names = [n for n in DECODERS.get(transfer_syntax, DEFAULT_DECODERS) if decoder_available(n)]
+    if (name := working_decoders.get(transfer_syntax)) in names:
+        names.remove(name)
+        names.insert(0, name)
+    return names
+
+
+def decode_pixels(dcm: pydicom.Dataset, path: str):
+    """Decodes with the first decoder that works for the transfer syntax of dcm, remembering which one did."""
+    transfer_syntax = str(getattr(dcm.file_meta, 'TransferSyntaxUID', ''))
+    errors = []
+    for name in decoders(transfer_syntax):
+        try:
+            img = decode(dcm, path, name)
+        except Exception as e:
+            errors.append(f'{name}: {e}')
+            continue
+        working_decoders[transfer_syntax] = name
+        return img
+    raise RuntimeError(f'No decoder could decode {path} ({transfer_syntax})\n' + '\n'.join(errors))
+
+
+def read_pixels(path: str):
+    """
+    Decodes the pixel data of a DICOM as a raw (rows, columns, samples) array, the middle frame of multi-frame files.
+    Returns the array along with the rescale slope and intercept.
+    """
+    dcm = pydicom.dcmread(path)
+    img = decode_pixels(dcm, path)
+    if int(dcm.get('NumberOfFrames', 1) or 1) > 1:
+        img = img[len(img) // 2]
+    if img.ndim == 2:
+        img = img[..., None]
+    return img, float(dcm.get('RescaleSlope', 1) or 1), float(dcm.get('RescaleIntercept', 0) or 0)
+
+
+def downsample(img: np.ndarray, size: int):
+    # strided, so no pixel values are computed
+    step = -(-max(img.shape[:2]) // size)
+    return img[::step, ::step]
+
+
+def window_bounds(img: np.ndarray, center: float = None, width: float = None, slope: float = 1., intercept: float = 0.):
+    """Returns the (low, high) raw pixel values of the window in rescaled units, or the pixel range if there is none."""
+    if center is None or not width:
+        return float(img.min()), float(img.max())
+    return (center - width / 2 - intercept) / slope, (center + width / 2 - intercept) / slope
+
+
+def window_level(img: np.ndarray, center: float = None, width: float = None, slope: float = 1., intercept: float = 0.):
+    """Maps raw pixel values to uint8, using the window in rescaled units or the pixel range if there is none."""
+    low, high = window_bounds(img, center, width, slope, intercept)
+    scale = 255 / max(high - low, 1e-6)
+    return np.clip((img.astype(np.float32) - low) * scale, 0, 255).astype(np.uint8)
+
+
+def lookup_table(dtype: np.dtype, low: float, high: float):
+    """
+    Returns a float32 table mapping every value of an 8 or 16-bit integer dtype to [0, 1] for the raw window
+    [low, high], indexed by the unsigned view of the pixels (see apply_lut). None for other dtypes.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iu' or dtype.itemsize > 2:
+        return None
+    values = np.arange(2 ** (8 * dtype.itemsize)).astype(f'u{dtype.itemsize}').view(dtype).astype(np.float32)
+    return np.clip((values - low) / max(high - low, 1e-6), 0, 1)
+
+
+def apply_lut(img: np.ndarray, lut: np.ndarray, out: np.ndarray = None):
+    # a single gather, viewing signed pixels as unsigned so they index the table directly
+    return np.take(lut, img.view(f'u{img.dtype.itemsize}'), out=out)
+
+
+def encode_thumbnail(img: np.ndarray):
+    """Returns (rows, columns, zlib compressed bytes) of a uint8 (rows, columns, samples) array."""
+    return img.shape[0], img.shape[1], zlib.compress(np.ascontiguousarray(img).tobytes())
+
+
+def decode_thumbnail(rows: int, columns: int, data: bytes):
+    return np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape(rows, columns, -1)
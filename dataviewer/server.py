@@ -0,0 +1,314 @@
+import os, json, queue, zlib, base64, sqlite3, threading, itertools, contextlib, urllib.parse, urllib.request, urllib.error
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+
+import click
+import numpy as np
+
+from dataviewer import pixels
+from dataviewer.db import Connection, FETCH_SIZE
+
+POOL_SIZE = 4
+QUERY_CACHE = 256 * 2 ** 20  # bytes of cached query responses
+PREVIEW_CACHE = 256 * 2 ** 20  # bytes of cached thumbnail and preview responses
+PREVIEW_SIZE = 1024
+
+
+class ConnectionPool:
+    """Read-only connections to one database, handed out to one request thread at a time."""
+
+    def __init__(self, path: Path, size: int = POOL_SIZE):
+        self._connections = queue.Queue()
+        for _ in range(size):
+            conn = Connection(path)
+            conn._conn.execute("PRAGMA cache_size=-65536")
+            self._connections.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = self._connections.get()
+        try:
+            yield conn
+        finally:
+            self._connections.put(conn)
+
+
+class ResponseCache:
+    """LRU cache of encoded responses bounded by their size, cleared whenever the database file changes."""
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+    def put(self, key, value: bytes):
+        with self._lock:
+            if key in self._items or len(value) > self.budget:
+                return
+            self._items[key] = value
+            self._size += len(value)
+            while self._size > self.budget:
+                self._size -= len(self._items.popitem(last=False)[1])
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+
+def encode_array(img: np.ndarray, **info):
+    return dict(**info, dtype=img.dtype.str, shape=img.shape,
+                data=base64.b64encode(zlib.compress(np.ascontiguousarray(img).tobytes())).decode())
+
+
+def decode_array(response: dict):
+    data = zlib.decompress(base64.b64decode(response['data']))
+    return np.frombuffer(data, dtype=response['dtype']).reshape(response['shape'])
+
+
+class Server(ThreadingHTTPServer):
+    """
+    Serves a database over a local HTTP/JSON API, see Handler. Row queries respond with JSON lines, the column names
+    followed by one line of rows per chunk, other requests with a single JSON object.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, path: Path, connections: int = POOL_SIZE, query_cache: int = QUERY_CACHE,
+                 preview_cache: int = PREVIEW_CACHE):
+        super().__init__(address, Handler)
+        self.path = path
+        self.pool = ConnectionPool(path, connections)
+        self.queries = ResponseCache(query_cache)
+        self.previews = ResponseCache(preview_cache)
+        self._mtime = os.stat(path).st_mtime
+        with self.pool.connection() as conn:
+            self.name, self.input = path.name, conn.input()
+
+    def check(self):
+        # an updated database invalidates every cached response
+        if (mtime := os.stat(self.path).st_mtime) != self._mtime:
+            self._mtime = mtime
+            self.queries.clear()
+            self.previews.clear()
+
+    def warm(self):
+        """Reads every table once and caches the unfiltered patient list every viewer starts with."""
+        with self.pool.connection() as conn:
+            for table, in conn._conn.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+                conn._conn.execute(f"SELECT COUNT(*) FROM [{table}]").fetchone()
+        q = dict(kvp={}, include_siblings=True)  # as sent by RemoteConnection.iterate_patients
+        self.queries.put(('/patients', json.dumps(q)), b''.join(self.rows('/patients', q)))
+
+    def rows(self, endpoint: str, q: dict):
+        kvp, siblings = q.get('kvp', {}), q.get('include_siblings', True)
+        with self.pool.connection() as conn:
+            if endpoint == '/select':
+                chunks = conn.iterate_select(siblings, q.get('columns'), FETCH_SIZE, q.get('within'), **kvp)
+            elif endpoint == '/patients':
+                chunks = conn.iterate_patients(siblings, **kvp)
+            else:
+                chunks = conn.iterate_studies(q['patient_id'], siblings, **kvp)
+            columns = None
+            for rows in chunks:
+                if columns is None:
+                    yield (json.dumps(columns := rows[0].keys()) + '\n').encode()
+                yield (json.dumps([tuple(row) for row in rows]) + '\n').encode()
+            if columns is None:
+                yield b'[]\n'
+
+    def respond(self, endpoint: str, q: dict):
+        with self.pool.connection() as conn:
+            if endpoint == '/info':
+                return dict(name=self.name, input=self.input)
+            if endpoint == '/count':
+                return conn.count(q.get('include_siblings', True), **q.get('kvp', {}))
+            if endpoint == '/get':
+                return dict(conn.get(q['rowid']))
+            if endpoint == '/instances':
+                return [dict(row) for row in conn.instances(q['path'])]
+            if endpoint == '/thumbnail':
+                return encode_array(img) if (img := conn.thumbnail(q['path'])) is not None else None
+        if endpoint == '/preview':
+            # decoded here, the archive only needs to be reachable from the server
+            # only files inside the input directory, the path comes from the client
+            root = os.path.realpath(self.input)
+            if os.path.commonpath([root, path := os.path.realpath(os.path.join(root, q['path']))]) != root:
+                raise ValueError(f"{q['path']} is outside the input directory")
+            img, slope, intercept = pixels.read_pixels(path)
+            return encode_array(pixels.downsample(img, q.get('size', PREVIEW_SIZE)), slope=slope, intercept=intercept)
+        raise LookupError(f"Unknown endpoint {endpoint}")
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    GET <endpoint>?q=<JSON parameters>
+    /select (kvp, include_siblings, columns, within), /patients (kvp, include_siblings),
+    /studies (patient_id, kvp, include_siblings), /count (kvp, include_siblings), /get (rowid), /instances (path),
+    /thumbnail (path), /preview (path relative to the input directory, size), /info
+    """
+    server: Server
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        raw = urllib.parse.parse_qs(url.query).get('q', ['{}'])[0]
+        key = url.path, raw
+        self.server.check()
+        try:
+            q = json.loads(raw)
+            if url.path in ['/select', '/patients', '/studies']:
+                if (cached := self.server.queries.get(key)) is None:
+                    return self.stream(key, self.server.rows(url.path, q))
+                body = cached
+            else:
+                cache = self.server.previews if url.path in ['/thumbnail', '/preview'] else self.server.queries
+                if (body := cache.get(key)) is None:
+                    body = json.dumps(self.server.respond(url.path, q)).encode()
+                    cache.put(key, body)
+        except Exception as e:
+            return self.send(400 if isinstance(e, (KeyError, ValueError, LookupError)) else 500,
+                             json.dumps(dict(error=f'{type(e).__name__}: {e}')).encode())
+        self.send(200, body)
+
+    def send(self, status: int, body: bytes):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def stream(self, key, lines):
+        # chunked, rows are sent as they are read and only cached if the whole response fits
+        lines, cached, size = iter(lines), [], 0
+        first = next(lines)  # raises before the headers are sent, for invalid selections
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for line in itertools.chain([first], lines):
+            self.wfile.write(f'{len(line):x}\r\n'.encode() + line + b'\r\n')
+            if cached is not None:
+                cached.append(line)
+                size += len(line)
+                if size > self.server.queries.budget:
+                    cached = None
+        self.wfile.write(b'0\r\n\r\n')
+        if cached is not None:
+            self.server.queries.put(key, b''.join(cached))
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(path: Path, host: str = '127.0.0.1', port: int = 8765, connections: int = POOL_SIZE,
+          cache: int = QUERY_CACHE):
+    server = Server((host, port), path, connections, cache, cache)
+    click.echo(f"Warming up {path}")
+    server.warm()
+    click.echo(f"Serving {path} at http://{host}:{server.server_port}, stop using Ctrl+C")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class Row(dict):
+    """A dict that also iterates over and indexes its values by position, like sqlite3.Row."""
+
+    def __iter__(self):
+        return iter(self.values())
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, slice)):
+            return tuple(self.values())[key]
+        return super().__getitem__(key)
+
+
+class RemoteConnection:
+    """The Connection interface used by the viewer and export, answered by a 'dataviewer serve' server."""
+
+    def __init__(self, url: str):
+        self.path = url.rstrip('/')
+        self._interrupted = threading.Event()
+        info = self._get('/info')
+        self.name, self._input = f"{info['name']} @ {self.path}", info['input']
+
+    def _open(self, endpoint: str, **q):
+        url = f"{self.path}{endpoint}?{urllib.parse.urlencode(dict(q=json.dumps(q)))}"
+        try:
+            return urllib.request.urlopen(url)
+        except urllib.error.HTTPError as e:
+            raise ValueError(json.loads(e.read()).get('error', str(e))) from None
+
+    def _get(self, endpoint: str, **q):
+        with self._open(endpoint, **q) as response:
+            return json.loads(response.read())
+
+    def _iterate(self, endpoint: str, **q):
+        self._interrupted.clear()
+        with self._open(endpoint, **q) as response:
+            columns = json.loads(response.readline())
+            while line := response.readline():
+                if self._interrupted.is_set():
+                    raise sqlite3.OperationalError("interrupted")
+                yield [Row(zip(columns, row)) for row in json.loads(line)]
+
+    def interrupt(self):
+        # like an interrupted local query, the running iterator raises sqlite3.OperationalError
+        self._interrupted.set()
+
+    def input(self):
+        return self._input
+
+    def iterate_select(self, include_siblings=True, columns: list = None, chunk_size: int = FETCH_SIZE,
+                       within: dict = None, **kvp):
+        return self._iterate('/select', kvp=kvp, include_siblings=include_siblings, columns=columns, within=within)
+
+    def iterate_all(self, columns: list = None, chunk_size: int = FETCH_SIZE):
+        return self.iterate_select(columns=columns, chunk_size=chunk_size)
+
+    def iterate_patients(self, include_siblings=True, chunk_size: int = FETCH_SIZE, **kvp):
+        return self._iterate('/patients', kvp=kvp, include_siblings=include_siblings)
+
+    def iterate_studies(self, patient_id, include_siblings=True, chunk_size: int = FETCH_SIZE, **kvp):
+        return self._iterate('/studies', patient_id=patient_id, kvp=kvp, include_siblings=include_siblings)
+
+    def count(self, include_siblings=True, **kvp):
+        return self._get('/count', kvp=kvp, include_siblings=include_siblings)
+
+    def get(self, rowid: int):
+        return Row(self._get('/get', rowid=rowid))
+
+    def instances(self, path: str):
+        return [Row(row) for row in self._get('/instances', path=path)]
+
+    def thumbnail(self, path: str):
+        return decode_array(response) if (response := self._get('/thumbnail', path=path)) else None
+
+    def preview(self, path: str, size: int = PREVIEW_SIZE):
+        """Returns the raw (pixels, slope, intercept) of a file relative to the input directory, decoded by the server."""
+        response = self._get('/preview', path=path, size=size)
+        return decode_array(response), response['slope'], response['intercept']
+
+    def select(self, include_siblings=True, **kvp):
+        R, series = [], []
+        for rows in self.iterate_select(include_siblings, **kvp):
+            for row in rows:
+                item = dict(row)
+                if item.pop('Selected'):
+                    series.append(item['SeriesInstanceUID'])
+                R.append(item)
+        return R, series
+
+    def select_all(self):
+        return self.select()[0]
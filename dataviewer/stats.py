@@ -0,0 +1,91 @@
+import os, json, time, threading, contextlib
+from collections import Counter
+from pathlib import Path
+
+import click
+
+
+class Stats:
+    """
+    Collects wall time, dossiers, files, bytes, busy time per worker and failures by exception type for every phase of
+    a build. Walking counts the files listed and their size, reading the files opened and the bytes read from them.
+    Phases overlap, walking, reading and writing are streamed into each other.
+    """
+
+    def __init__(self, **info):
+        self.info = info
+        self.phases = dict()
+        self.created = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def _phase(self, name: str):
+        if name not in self.phases:
+            self.phases[name] = dict(start=None, end=None, dossiers=0, files=0, bytes=0, failures=Counter(), workers=dict())
+        return self.phases[name]
+
+    def start(self, name: str):
+        with self._lock:
+            phase = self._phase(name)
+            phase['start'] = phase['start'] or time.perf_counter()
+
+    def stop(self, name: str):
+        with self._lock:
+            self._phase(name)['end'] = time.perf_counter()
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(name)
+
+    def add(self, name: str, dossiers: int = 0, files: int = 0, bytes: int = 0, busy: float = None, worker: str = None):
+        with self._lock:
+            phase = self._phase(name)
+            phase['dossiers'] += dossiers
+            phase['files'] += files
+            phase['bytes'] += bytes
+            if busy is not None:
+                w = phase['workers'].setdefault(worker or 'main', dict(busy_seconds=0., dossiers=0))
+                w['busy_seconds'] += busy
+                w['dossiers'] += dossiers
+
+    def fail(self, name: str, error: str, count: int = 1):
+        with self._lock:
+            self._phase(name)['failures'][error] += count
+
+    def report(self):
+        phases = dict()
+        for name, phase in self.phases.items():
+            seconds = ((phase['end'] or time.perf_counter()) - phase['start']) if phase['start'] else 0.
+            rate = lambda n: n / seconds if seconds > 0 else None
+            phases[name] = dict(
+                seconds=seconds, dossiers=phase['dossiers'], files=phase['files'], bytes=phase['bytes'],
+                dossiers_per_second=rate(phase['dossiers']), files_per_second=rate(phase['files']),
+                bytes_per_second=rate(phase['bytes']), failures=dict(phase['failures']),
+                workers={w: dict(**v, utilisation=v['busy_seconds'] / seconds if seconds > 0 else None)
+                         for w, v in phase['workers'].items()})
+        return dict(**self.info, seconds=time.perf_counter() - self.created, phases=phases)
+
+    def write(self, path: Path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, default=str)
+        click.echo(f"Statistics written to {os.path.abspath(path)}")
+
+    def summary(self):
+        report = self.report()
+        lines = [f"Finished in {report['seconds']:.1f} s"]
+        for name, phase in report['phases'].items():
+            line = f"  {name:<8} {phase['seconds']:8.1f} s {phase['dossiers']:8} dossiers"
+            if phase['dossiers_per_second']:
+                line += f" {phase['dossiers_per_second']:8.1f} dossiers/s"
+            if phase['files']:
+                line += f" {phase['files']:8} files {phase['bytes'] / 2 ** 20:8.1f} MiB"
+            if workers := phase['workers'].values():
+                utilisation = [w['utilisation'] or 0 for w in workers]
+                line += f" {len(utilisation)} workers {100 * sum(utilisation) / len(utilisation):.0f}% busy"
+            if phase['failures']:
+                line += ' failed: ' + ', '.join(f'{n} {e}' for e, n in phase['failures'].items())
+            lines.append(line)
+        return '\n'.join(lines)
@@ -0,0 +1,110 @@
+# kept free of heavy imports, the CLI reads these without loading db
+dcm_tags = {  # Attributes
+    "0008|0005": "SpecificCharacterSet",
+    "0008|0008": "ImageType",
+    "0008|0012": "InstanceCreationDate",
+    "0008|0013": "InstanceCreationTime",
+    "0008|0016": "SOPClassUID",
+    "0008|0018": "SOPInstanceUID",
+    "0008|0020": "StudyDate",
+    "0008|0021": "SeriesDate",
+    "0008|0022": "AcquisitionDate",
+    "0008|0023": "ContentDate",
+    "0008|0030": "StudyTime",
+    "0008|0031": "SeriesTime",
+    "0008|0032": "AcquisitionTime",
+    "0008|0033": "ContentTime",
+    "0008|0050": "AccessionNumber",
+    "0008|0060": "Modality",
+    "0008|0070": "Manufacturer",
+    "0008|1010": "StationName",
+    "0008|1030": "StudyDescription",
+    "0008|103e": "SeriesDescription",
+    "0008|1040": "InstitutionalDepartmentName",
+    "0008|1090": "ManufacturersModelName",
+    "0010|0020": "PatientID",
+    "0010|0030": "PatientsBirthDate",
+    "0010|0040": "PatientsSex",
+    "0010|1010": "PatientsAge",
+    "0010|21b0": "AdditionalPatientHistory",
+    "0012|0062": "PatientIdentityRemoved",
+    "0012|0063": "DeidentificationMethod",
+    "0018|0015": "BodyPartExamined",
+    "0018|0020": "ScanningSequence",
+    "0018|0021": "SequenceVariant",
+    "0018|0022": "ScanOptions",
+    "0018|0023": "MRAcquisitionType",
+    "0018|0024": "SequenceName",
+    "0018|0050": "SliceThickness",
+    "0018|0080": "RepetitionTime",
+    "0018|0081": "EchoTime",
+    "0018|0083": "NumberofAverages",
+    "0018|0084": "ImagingFrequency",
+    "0018|0085": "ImagedNucleus",
+    "0018|0087": "MagneticFieldStrength",
+    "0018|0088": "SpacingBetweenSlices",
+    "0018|0089": "NumberofPhaseEncodingSteps",
+    "0018|0091": "EchoTrainLength",
+    "0018|0093": "PercentSampling",
+    "0018|0094": "PercentPhaseFieldofView",
+    "0018|1000": "DeviceSerialNumber",
+    "0018|1030": "ProtocolName",
+    "0018|1310": "AcquisitionMatrix",
+    "0018|1312": "InplanePhaseEncodingDirection",
+    "0018|1314": "FlipAngle",
+    "0018|1315": "VariableFlipAngleFlag",
+    "0018|5100": "PatientPosition",
+    "0018|9087": "Diffusionbvalue",
+    "0020|000d": "StudyInstanceUID",
+    "0020|000e": "SeriesInstanceUID",
+    "0020|0010": "StudyID",
+    "0020|0032": "ImagePositionPatient",
+    "0020|0037": "ImageOrientationPatient",
+    "0020|0052": "FrameofReferenceUID",
+    "0020|1041": "SliceLocation",
+    "0028|0002": "SamplesperPixel",
+    "0028|0010": "Rows",
+    "0028|0011": "Columns",
+    "0028|0030": "PixelSpacing",
+    "0028|0100": "BitsAllocated",
+    "0028|0101": "BitsStored",
+    "0028|0106": "SmallestImagePixelValue",
+    "0028|0107": "LargestImagePixelValue",
+    "0028|1050": "WindowCenter",
+    "0028|1051": "WindowWidth",
+    "0040|0244": "PerformedProcedureStepStartDate",
+    "0040|0254": "PerformedProcedureStepDescription"
+}
+
+# values are converted once at ingest, dates are stored as ISO 8601 text, anything not listed here is TEXT
+dcm_types = {
+    **{name: 'DATE' for name in ["InstanceCreationDate", "StudyDate", "SeriesDate", "AcquisitionDate", "ContentDate",
+                                 "PatientsBirthDate", "PerformedProcedureStepStartDate"]},
+    **{name: 'REAL' for name in ["SliceThickness", "RepetitionTime", "EchoTime", "NumberofAverages", "ImagingFrequency",
+                                 "MagneticFieldStrength", "SpacingBetweenSlices", "PercentSampling",
+                                 "PercentPhaseFieldofView", "FlipAngle", "Diffusionbvalue", "SliceLocation",
+                                 "WindowCenter", "WindowWidth"]},
+    **{name: 'INTEGER' for name in ["NumberofPhaseEncodingSteps", "EchoTrainLength", "SamplesperPixel", "Rows", "Columns",
+                                    "BitsAllocated", "BitsStored", "SmallestImagePixelValue", "LargestImagePixelValue"]},
+}
+
+TAGS = [int(key.replace('|', ''), 16) for key in dcm_tags]
+COLUMNS = ['SeriesLength', 'Path', 'Sample'] + [h.replace(' ', '_').strip() for h in dcm_tags.values()]
+COLUMN_TYPES = {'SeriesLength': 'INTEGER', 'Path': 'TEXT', 'Sample': 'TEXT',
+                **{c: dcm_types.get(c, 'TEXT') for c in COLUMNS[3:]}}
+
+# exact matches on these columns use an index, substring matches on the free-text columns use a trigram FTS5 table
+INDEXED = ['StudyInstanceUID', 'SeriesInstanceUID', 'PatientID', 'Modality',
+           'StudyDate', 'SeriesDate', 'AcquisitionDate', 'ContentDate',
+           'EchoTime', 'RepetitionTime', 'SliceThickness', 'Diffusionbvalue', 'MagneticFieldStrength']
+FULL_TEXT = ['SeriesDescription', 'StudyDescription', 'ProtocolName', 'SequenceName']
+
+# per file fields of the optional Instances table, keyed to Dossiers by Path
+INSTANCE_TAGS = {
+    0x00080018: "SOPInstanceUID",
+    0x0020000E: "SeriesInstanceUID",
+    0x00200013: "InstanceNumber",
+    0x00200032: "ImagePositionPatient",
+    0x00080032: "AcquisitionTime",
+}
+INSTANCE_COLUMNS = ['Path', 'File'] + list(INSTANCE_TAGS.values()) + ['Size']
@@ -1,16 +1,28 @@
-import os, webbrowser, threading, queue, concurrent.futures
+import os, webbrowser, threading, functools, concurrent.futures
 from collections import OrderedDict
 from pathlib import Path
 
-import pandas as pd, pydicom, dearpygui.dearpygui as dpg, numpy as np, SimpleITK as sitk
+import pandas as pd, dearpygui.dearpygui as dpg, numpy as np, SimpleITK as sitk
 
-isr = sitk.ImageSeriesReader()
-texture_registry = set()
+from dataviewer import pixels
+from dataviewer.db import Connection, parse_selection
+
+preview_executor = concurrent.futures.ThreadPoolExecutor(2)
+slice_executor = concurrent.futures.ThreadPoolExecutor(4)
+# filter queries run one at a time, on a connection of their own
+filter_executor = concurrent.futures.ThreadPoolExecutor(1)
 whitelist = ['SeriesLength', 'StudyDate', 'StudyTime', 'SeriesDate', 'SeriesTime',
              'Modality', 'Manufacturer', 'ManufacturersModelName', 'SequenceName',
              'PatientID', 'StudyDescription', 'SeriesDescription']
 viewport_size = [1024, 768]
 max_item_width = 700
+preview_size = 1024
+preview_budget = 256 * 2 ** 20  # bytes of cached preview arrays
+slice_budget = 256 * 2 ** 20  # bytes of cached slices per series window
+slice_prefetch = 3  # slices on either side of the current one
+filter_delay = .3  # seconds without edits before the filter bar queries
+# series buttons only need these, full rows are fetched by rowid when a series is opened
+tree_columns = ['index', 'Path', 'SeriesInstanceUID', 'SeriesDescription']
 
 
 def item_get(item, key, alt=None):
@@ -18,91 +30,317 @@ def item_get(item, key, alt=None):
     return value if value is not None else alt
 
 
+class PreviewCache:
+    """
+    LRU cache of preview arrays and their raw textures, keyed by (SeriesInstanceUID, sample path) and bounded by
+    the size of the arrays. The source is the raw (pixels, slope, intercept) of a decoded preview, so it can be
+    window-levelled again. Textures of open series windows are held, evicted textures
+    are deleted.
+    """
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._items = OrderedDict()  # key: (rgba, texture, source)
+        self._held = dict()  # key: count
+        self._size = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                return self._items[key]
+
+    def put(self, key, rgba: np.ndarray, source: tuple = None):
+        with self._lock:
+            if key in self._items:
+                return self.get(key)
+            height, width = rgba.shape[:2]
+            # raw textures do not copy, the cache keeps the buffer alive for as long as the texture exists
+            texture = dpg.add_raw_texture(width, height, rgba, format=dpg.mvFormat_Float_rgba, parent='textures')
+            self._items[key] = rgba, texture, source
+            self._size += rgba.nbytes + (source[0].nbytes if source else 0)
+            self._evict()
+            return self._items[key]
+
+    def hold(self, key):
+        with self._lock:
+            self._held[key] = self._held.get(key, 0) + 1
+
+    def release(self, key):
+        with self._lock:
+            if (count := self._held.pop(key, 0) - 1) > 0:
+                self._held[key] = count
+            self._evict()
+
+    def _evict(self):
+        for key in [k for k in self._items if k not in self._held]:
+            if self._size <= self.budget:
+                break
+            rgba, texture, source = self._items.pop(key)
+            self._size -= rgba.nbytes + (source[0].nbytes if source else 0)
+            dpg.delete_item(texture)
+
+
+previews = PreviewCache(preview_budget)
+
+
+class SliceCache:
+    """
+    Loads the slices of a series on demand, prefetching the neighbours of the requested slice on a background pool.
+    Loaded slices are kept as raw arrays up to budget bytes, evicting the least recently requested ones first.
+    Pending loads that are no longer near the requested slice are cancelled.
+    """
+
+    def __init__(self, paths: list, budget: int = slice_budget, prefetch: int = slice_prefetch):
+        self.paths = paths
+        self.budget = budget
+        self.prefetch = prefetch
+        self._futures = OrderedDict()  # index: future
+        self._current = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.paths)
+
+    def get(self, index: int) -> concurrent.futures.Future:
+        with self._lock:
+            self._current = index
+            neighbours = [index + d * s for d in range(1, self.prefetch + 1) for s in (1, -1)]
+            for i in [index] + neighbours:
+                if 0 <= i < len(self.paths) and i not in self._futures:
+                    self._futures[i] = slice_executor.submit(load_preview, self.paths[i])
+            self._futures.move_to_end(index)
+            self._evict()
+            return self._futures[index]
+
+    def close(self):
+        with self._lock:
+            [future.cancel() for future in self._futures.values()]
+            self._futures.clear()
+
+    def _evict(self):
+        loaded = lambda f: f.done() and not f.cancelled() and f.exception() is None
+        size = sum(f.result()[0].nbytes for f in self._futures.values() if loaded(f))
+        for i, future in list(self._futures.items()):
+            if abs(i - self._current) <= self.prefetch:
+                continue
+            if not future.done():
+                if future.cancel():
+                    del self._futures[i]
+            elif size > self.budget:
+                size -= future.result()[0].nbytes if loaded(future) else 0
+                del self._futures[i]
+
+
+class WindowLevel:
+    """
+    Window center and width in rescaled units, applied to raw pixel arrays through lookup tables. Tables are built
+    once per dtype and rescale, and rebuilt only when the window changes. Without a stored window, the window is set
+    to the pixel range of the first array applied. Listeners are called with the window whenever it changes.
+    """
+
+    def __init__(self, center: float = None, width: float = None):
+        self.center, self.width = center, width
+        self.default = center, width
+        self.listeners = []
+        self._luts = dict()
+
+    def set(self, center: float, width: float):
+        self.center, self.width = center, max(width, 1.)
+        self._luts.clear()
+        [f(self) for f in self.listeners]
+
+    def reset(self):
+        if self.default[0] is not None:
+            self.set(*self.default)
+
+    def apply(self, img: np.ndarray, slope: float = 1., intercept: float = 0., rgba: np.ndarray = None):
+        """Returns img mapped to a float32 RGBA array flipped for plots, written into rgba if given."""
+        if self.center is None or not self.width:
+            low, high = pixels.window_bounds(img)
+            self.default = (low + high) / 2 * slope + intercept, (high - low) * slope
+            self.set(*self.default)
+
+        key = img.dtype.str, slope, intercept
+        if key not in self._luts:
+            low, high = pixels.window_bounds(img, self.center, self.width, slope, intercept)
+            self._luts[key] = (low, high), pixels.lookup_table(img.dtype, low, high)
+        (low, high), lut = self._luts[key]
+        if lut is not None:
+            values = pixels.apply_lut(img[..., :3], lut)
+        else:
+            values = np.clip((img[..., :3].astype(np.float32) - low) / max(high - low, 1e-6), 0, 1)
+
+        if rgba is None:
+            rgba = np.ones((*img.shape[:2], 4), dtype=np.float32)
+        rgba[..., :3] = values[::-1]
+        return rgba
+
+
+def patient_label(patient_id, studies, series, selected):
+    return f'{patient_id} {label_summary(1, studies, selected)}'
+
+
+def label_summary(tier, count, results=0):
+    sing, plu = (('patient', 'patients'), ('study', 'studies'), ('series', 'series'))[tier]
+    plural = lambda s, p, c: f'{c} {s}' if c == 1 else f'{c} {p}'
+    count = plural(sing, plu, count)
+    if results > 0:
+        results = plural('result', 'results', results)
+        return f'({count}, {results})'
+    return f'({count})'
+
+
+def selection_text(kvp: dict):
+    # the filter bar syntax, --select items separated by semicolons
+    return '; '.join(f'{k}{v}' if v[:1] in '<>!' else f'{k}={v}' for k, v in (kvp or {}).items())
+
+
 class Viewer:
-    def __init__(self, db: Path, input_path: Path, items, kvp=None, series=None):
+    def __init__(self, conn: Connection, input_path: Path, kvp=None):
         dpg.create_context()
-        dpg.create_viewport(title=f'RUMC data viewer ({db.name})', width=viewport_size[0], height=viewport_size[1])
+        dpg.create_viewport(title=f'RUMC data viewer ({conn.name})', width=viewport_size[0], height=viewport_size[1])
         dpg.setup_dearpygui()
 
+        self.conn = conn
         self.input_path = str(input_path)
         self.input_path_default = self.input_path
         self.selection = kvp
-        self.items = items
-        self.series = series if series is not None else []
         self.explorer = -1
-        self.queue = queue.SimpleQueue()
+        self.expand_handler = -1
+        self.patients = dict()  # PatientID: (tree node, (Studies, Series, Selected))
+        self.populating = None
+        self.filter_conn = None
+        self.filter_timer = None
+        self.filter_generation = 0
+        self.filter_error = -1
 
     def populate_tree(self):
-        total_items = len(self.items)
-        dpg.configure_item(self.explorer, label=f'Explorer (loading {total_items} results)')
+        """
+        Only patient nodes are created up front, from a grouped query. Studies and series are queried and
+        created when their parent node is expanded for the first time.
+        """
+        kvp = self.selection or {}
+        dpg.configure_item(self.explorer, label='Explorer (loading)')
+
+        with dpg.item_handler_registry() as self.expand_handler:
+            dpg.add_item_toggled_open_handler(callback=self.callback_expand)
 
         def thread_populate():
-            def create_item(item):
+            patients, results = 0, 0
+            for rows in self.conn.iterate_patients(**kvp):
                 with dpg.stage() as stage:
-                    patient_id = str(item['PatientID'])
-                    study_id = str(item['StudyInstanceUID'])
-                    series_id = str(item['SeriesInstanceUID'])
-
-                    patient = None if dpg.does_item_exist(patient_id) else dpg.add_tree_node(tag=patient_id, label=patient_id, user_data=0)
-                    study = None if dpg.does_item_exist(study_id) else \
-                        dpg.add_tree_node(parent=patient_id, tag=study_id, user_data=0, label=item_get(item, 'StudyDescription', f'Study {item["index"]}'))
-
-                    if not dpg.does_item_exist(series_id):
-                        s = dpg.add_button(parent=study_id, tag=series_id, user_data=(item, lambda: self.input_path), callback=callback_item,
-                                           label=item_get(item, 'SeriesDescription', f'Series {item["index"]}'))
-                        if series_id in self.series:
-                            dpg.bind_item_theme(s, 'theme_select')
-                            for id in [study_id, patient_id, self.explorer]:
-                                dpg.set_item_user_data(id, dpg.get_item_user_data(id) + 1)
-                self.queue.put((stage, patient, study))
-
-            with concurrent.futures.ThreadPoolExecutor(min(32, (os.cpu_count() or 1) + 4)) as executor:
-                executor.map(create_item, self.items)
-
-            self.queue.put(-1)
-
-        (t_populate := threading.Thread(target=thread_populate)).start()
-
-        def thread_load():
-            gets = []
-            progress = dpg.add_progress_bar(parent=self.explorer, overlay='0%')
-            while t_populate.is_alive():
-                if (get := self.queue.get()) != -1:
-                    gets.append(get)
-                    dpg.set_value(progress, p := (len(gets) / total_items))
-                    dpg.configure_item(progress, overlay=str(round(p * 100)) + '%')
-
-            stages, patients, studies = tuple(list(filter(None, x)) for x in zip(*gets))
-            plurals = (('patient', 'patients'), ('study', 'studies'), ('series', 'series'))
-
-            def label_summary(tier, count, results = 0):
-                sing, plu = plurals[tier]
-                plural = lambda s, p, c: f'{c} {s}' if c == 1 else f'{c} {p}'
-                count = plural(sing, plu, count)
-                if results > 0:
-                    results = plural('result', 'results', results)
-                    return f'({count}, {results})'
-                return f'({count})'
-
-            dpg.configure_item(self.explorer, label=f'Explorer {label_summary(0, len(patients), dpg.get_item_user_data(self.explorer))}')
-
-            for nodes, tier in [(patients, 1), (studies, 2)]:
-                for node in nodes:
-                    l, c = dpg.get_item_label(node), len(dpg.get_item_children(node)[1])
-                    dpg.configure_item(node, label=f'{l} {label_summary(tier, c, dpg.get_item_user_data(node))}')
-
-            dpg.delete_item(progress)
-
-            for stage in stages:
+                    for row in rows:
+                        node = dpg.add_tree_node(label=patient_label(*row), user_data=('PatientID', row['PatientID']))
+                        dpg.bind_item_handler_registry(node, self.expand_handler)
+                        self.patients[row['PatientID']] = node, tuple(row)[1:]
                 dpg.push_container_stack(self.explorer)
                 dpg.unstage(stage)
                 dpg.pop_container_stack()
+                if dpg.does_item_exist(stage):
+                    dpg.delete_item(stage)
+
+                patients, results = patients + len(rows), results + sum(row['Selected'] for row in rows)
+                dpg.configure_item(self.explorer, label=f'Explorer (loading {label_summary(0, patients, results)[1:]}')
 
-        (t_load := threading.Thread(target=thread_load)).start()
-        return t_populate, t_load
+            dpg.configure_item(self.explorer, label=f'Explorer {label_summary(0, patients, results)}')
+
+        (t_populate := threading.Thread(target=thread_populate)).start()
+        return t_populate
+
+    def callback_expand(self, sender, node):
+        # user_data is cleared once the children are created
+        if (user_data := dpg.get_item_user_data(node)) is None:
+            return
+        dpg.set_item_user_data(node, None)
+
+        key, value = user_data
+        kvp = self.selection or {}
+        if key == 'PatientID':
+            for rows in self.conn.iterate_studies(value, **kvp):
+                for row in rows:
+                    label = item_get(row, 'StudyDescription', f'Study {row["index"]}')
+                    study = dpg.add_tree_node(parent=node, label=f'{label} {label_summary(2, row["Series"], row["Selected"])}',
+                                              user_data=('StudyInstanceUID', row['StudyInstanceUID']))
+                    dpg.bind_item_handler_registry(study, self.expand_handler)
+        else:
+            for rows in self.conn.iterate_select(columns=tree_columns, within={key: value}, **kvp):
+                for item in rows:
+                    s = dpg.add_button(parent=node, callback=callback_item,
+                                       user_data=(functools.partial(self.conn.get, item['rowid']), lambda: self.input_path,
+                                                  functools.partial(self.conn.thumbnail, item['Path']),
+                                                  functools.partial(self.conn.instances, item['Path']),
+                                                  getattr(self.conn, 'preview', None)),
+                                       label=item_get(item, 'SeriesDescription', f'Series {item["index"]}'))
+                    if item['Selected']:
+                        dpg.bind_item_theme(s, 'theme_select')
+
+    def callback_filter(self, sender, text):
+        """Debounced, the query only runs once edits pause. A query still running for an older edit is interrupted."""
+        self.filter_generation += 1
+        generation = self.filter_generation
+        if self.filter_timer:
+            self.filter_timer.cancel()
+        if self.filter_conn:
+            self.filter_conn.interrupt()
+        self.filter_timer = threading.Timer(filter_delay, filter_executor.submit, (self.apply_filter, generation, text))
+        self.filter_timer.start()
+
+    def apply_filter(self, generation, text):
+        if generation != self.filter_generation:
+            return
+        # runs on filter_executor, where an escaping exception would disappear into its future
+        try:
+            kvp = dict(parse_selection(item) for item in text.split(';') if item.strip())
+            self.filter_conn = self.filter_conn or type(self.conn)(self.conn.path)
+            rows = [tuple(row) for rows in self.filter_conn.iterate_patients(**kvp) for row in rows]
+        except Exception as e:
+            # an interrupted query means a newer edit is on its way
+            if generation == self.filter_generation:
+                dpg.set_value(self.filter_error, f'Ignored filter, {e}')
+                dpg.configure_item(self.filter_error, show=True)
+            return
+        if generation != self.filter_generation:
+            return
+        dpg.configure_item(self.filter_error, show=False)
+        if self.populating:
+            self.populating.join()
+        self.selection = kvp or None
+        self.update_tree(rows)
+
+    def update_tree(self, rows: list):
+        """
+        Updates the patient nodes to (PatientID, Studies, Series, Selected) rows ordered by PatientID. Only changed
+        labels are set, and only the children of expanded patients are rebuilt, others are still created on expand.
+        """
+        rows = {row[0]: row[1:] for row in rows}
+        for patient_id in [p for p in self.patients if p not in rows]:
+            dpg.delete_item(self.patients.pop(patient_id)[0])
+
+        # in reverse, so new nodes can be inserted before the next patient
+        before = 0
+        for patient_id, counts in reversed(rows.items()):
+            if patient_id in self.patients:
+                node, previous = self.patients[patient_id]
+                if counts != previous:
+                    dpg.set_item_label(node, patient_label(patient_id, *counts))
+                if dpg.get_item_user_data(node) is None:
+                    dpg.delete_item(node, children_only=True)
+                    dpg.set_item_user_data(node, ('PatientID', patient_id))
+                    if dpg.get_value(node):
+                        self.callback_expand(None, node)
+            else:
+                node = dpg.add_tree_node(parent=self.explorer, before=before, label=patient_label(patient_id, *counts),
+                                         user_data=('PatientID', patient_id))
+                dpg.bind_item_handler_registry(node, self.expand_handler)
+            self.patients[patient_id] = node, counts
+            before = node
+
+        dpg.configure_item(self.explorer, label=f'Explorer {label_summary(0, len(rows), sum(c[2] for c in rows.values()))}')
 
     def create_explorer(self):
-        with dpg.window(autosize=True, min_size=[300, 100], no_close=True, max_size=viewport_size, user_data=0) as self.explorer:
+        with dpg.window(autosize=True, min_size=[300, 100], no_close=True, max_size=viewport_size) as self.explorer:
             try:
                 dpg.add_button(label='Edit source directory', callback=lambda: dpg.show_item('source'), width=300)
 
@@ -116,9 +354,13 @@ class Viewer:
                                     dpg.add_text(k)
                                     dpg.add_input_text(default_value=v, readonly=True, width=200)
 
+                dpg.add_input_text(hint='Filter, e.g. Modality=MR; EchoTime>80', width=300, callback=self.callback_filter,
+                                   default_value=selection_text(self.selection))
+                self.filter_error = dpg.add_text('', show=False, color=(255, 96, 96))
+
                 dpg.add_separator()
 
-                self.populate_tree()
+                self.populating = self.populate_tree()
             except Exception as e:
                 with dpg.collapsing_header(label='An error occurred while loading results') as c:
                     dpg.bind_item_theme(c, 'theme_error')
@@ -150,8 +392,7 @@ class Viewer:
                 if key == 27:
                     d = list(callback_items.keys()) + [f for f in callback_items.keys() if dpg.is_item_focused(f)]
                     if len(d) > 0:
-                        dpg.delete_item(callback_items[(d := d.pop())])
-                        callback_items.pop(d)
+                        close_item(d.pop())
             dpg.add_key_press_handler(callback=callback_close)
 
         def callback_source_input(sender):
@@ -169,6 +410,8 @@ class Viewer:
             dpg.add_text('The source directory is the parent directory of all data shown,\nused for loading previews.')
             dpg.add_button(tag='source_default', label=" Reset to default ", callback=callback_source_default)
 
+        dpg.add_texture_registry(tag='textures')
+
         self.create_explorer()
         with dpg.viewport_menu_bar(tag='menu'):
             dpg.add_menu_item(label="Close (ESC) ", callback=dpg.destroy_context)
@@ -193,24 +436,33 @@ callback_items = OrderedDict()
 
 
 def callback_item(sender, _, user_data):
-    item, get_input_path = user_data
+    get_item, get_input_path, get_thumbnail, get_instances, get_preview = user_data
 
     if sender in callback_items:
+        dpg.focus_item(callback_items[sender])
         return
 
-    labels = []
+    item = get_item()
+
+    labels, node = [], sender
     for _ in range(3):
-        labels.append(dpg.get_item_label(sender).rsplit('(')[0].strip())
-        sender = dpg.get_item_parent(sender)
+        labels.append(dpg.get_item_label(node).rsplit('(')[0].strip())
+        node = dpg.get_item_parent(node)
     labels.reverse()
 
-    def exception_text(label, e):
-        with dpg.collapsing_header(label=label) as c:
+    def exception_text(label, e, parent=0):
+        with dpg.collapsing_header(label=label, parent=parent) as c:
             dpg.bind_item_theme(c, 'theme_error')
             dpg.add_input_text(default_value=e, readonly=True, width=max_item_width)
 
 
-    with dpg.window(label='/'.join(labels), autosize=True, on_close=lambda: callback_items.pop(sender)) as w:
+    sample = os.path.join(get_input_path(), item['Path'], item['Sample'])
+    key = item['SeriesInstanceUID'], sample
+    previews.hold(key)
+    cleanup = []  # called when the window closes
+    window = WindowLevel(item_get(item, 'WindowCenter'), item_get(item, 'WindowWidth'))
+
+    with dpg.window(label='/'.join(labels), autosize=True, user_data=(key, cleanup), on_close=lambda: close_item(sender)) as w:
         dpg.bind_item_theme(w, 'theme_item')
 
         expand = dpg.add_button(label='Expand', callback=callback_toggle_item, width=300)
@@ -234,7 +486,7 @@ def callback_item(sender, _, user_data):
                         with dpg.table_row(show=white, user_data=white):
                             key_column.append(dpg.add_text(k, color=(-255, 0, 0) if v_exists else (128, 128, 128)))
                             if v_exists:
-                                value_column.append(dpg.add_input_text(default_value=v, readonly=True))
+                                value_column.append(dpg.add_input_text(default_value=str(v), readonly=True))
 
                 max_column_width = max([dpg.get_text_size(dpg.get_value(c))[0] for c in key_column])
                 [dpg.set_item_width(c, int(max_item_width - max_column_width)) for c in value_column]
@@ -251,29 +503,202 @@ def callback_item(sender, _, user_data):
             exception_text('Failed to read this series', e)
 
         # clipboard
-        sample = os.path.join(get_input_path(), item['Path'], item['Sample'])
         dpg.add_button(label='Copy sample path to clipboard', enabled=os.path.exists(sample), width=300,
                        callback=lambda: pd.DataFrame([sample]).to_clipboard(index=False,header=False))
         with dpg.tooltip(dpg.last_item()):
             dpg.add_text('Copy: ' + os.path.join(item['Path'], item['Sample']))
 
-        # preview
-        try:
-            img = pydicom.read_file(sample).pixel_array
-            with dpg.texture_registry():
-                texture_data = []
-                [texture_data.extend([px, px, px, 1]) for px in np.flipud(img).flatten() / img.max(initial=1)]
-                tex = dpg.add_static_texture(img.shape[0], img.shape[1], texture_data)
-            with dpg.collapsing_header(label=f'Sample: {item["Sample"]}', default_open=True):
-                with dpg.plot(height=img.shape[0] * 2, width=img.shape[1] * 2):
-                    [dpg.add_plot_axis(axis, no_tick_marks=True) for axis in [dpg.mvXAxis, dpg.mvYAxis]]
-                    dpg.draw_image(tex, pmin=[0, 0], pmax=[1, 1])  # img.shape)
-        except Exception as e:
-            exception_text('Failed to load DICOM image for preview', e)
+        controls = add_window_controls(w, window, cleanup)
+
+        # preview, decoded and converted on a worker thread so rendering never blocks
+        with dpg.collapsing_header(label=f'Sample: {item["Sample"]}', default_open=True) as header:
+            placeholder = [dpg.add_text('Loading preview...')]  # items replaced by the decoded preview
+
+        def remove_placeholder():
+            [dpg.delete_item(p) for p in placeholder if dpg.does_item_exist(p)]
+            placeholder.clear()
+
+        def draw(tex, rgba: np.ndarray):
+            height, width = rgba.shape[:2]
+            scale = min(2., preview_size / max(height, width))
+            with dpg.plot(parent=header, height=int(height * scale), width=int(width * scale)) as plot:
+                [dpg.add_plot_axis(axis, no_tick_marks=True) for axis in [dpg.mvXAxis, dpg.mvYAxis]]
+                dpg.draw_image(tex, pmin=[0, 0], pmax=[1, 1], parent=plot)
+            return plot
+
+        def show_preview(rgba: np.ndarray, source: tuple):
+            rgba, tex, source = previews.put(key, rgba, source)
+            # the cached array may have been levelled with another window
+            redraw = lambda window: dpg.set_value(tex, window.apply(*source, rgba=rgba))
+            redraw(window)
+            window.listeners.append(redraw)
+            cleanup.append(lambda: window.listeners.remove(redraw))
+            draw(tex, rgba)
+
+        def show_thumbnail(thumbnail: np.ndarray):
+            # already levelled, so only shown until the sample is decoded, the raw texture keeps rgba alive
+            rgba = to_rgba(thumbnail[..., :3] / np.float32(255))
+            tex = dpg.add_raw_texture(rgba.shape[1], rgba.shape[0], rgba, format=dpg.mvFormat_Float_rgba, parent='textures')
+            remove_placeholder()
+            placeholder.extend([draw(tex, rgba), tex])
+            cleanup.append(remove_placeholder)
+
+        def show_future(future):
+            if not dpg.does_item_exist(header):
+                # the window was closed in the meantime, still cache the preview for next time
+                if not future.exception():
+                    previews.put(key, window.apply(*future.result()), future.result())
+                return
+            try:
+                rgba = window.apply(*future.result())
+                remove_placeholder()
+                show_preview(rgba, future.result())
+            except Exception as e:
+                if placeholder and dpg.get_item_type(placeholder[0]).endswith('Text'):
+                    remove_placeholder()
+                else:
+                    # the thumbnail stays, but can not be levelled
+                    dpg.configure_item(controls, show=False)
+                exception_text('Failed to load DICOM image for preview', e, parent=header)
+
+        add_slice_browser(w, os.path.join(get_input_path(), item['Path']), item['SeriesInstanceUID'], get_instances,
+                          window, cleanup)
+
+        if cached := previews.get(key):
+            remove_placeholder()
+            show_preview(*cached[::2])
+        else:
+            if (thumbnail := get_thumbnail()) is not None:
+                # stored by 'new --thumbnails', available even when the source directory is not
+                show_thumbnail(thumbnail)
+            if get_preview and not os.path.exists(sample):
+                # served by 'dataviewer serve', decoded where the source directory is
+                preview_executor.submit(get_preview, os.path.join(item['Path'], item['Sample'])).add_done_callback(show_future)
+            elif thumbnail is not None and not os.path.exists(sample):
+                # nothing to decode, the window controls would not change the thumbnail
+                dpg.configure_item(controls, show=False)
+            else:
+                preview_executor.submit(load_preview, sample).add_done_callback(show_future)
 
     callback_items[sender] = w
 
 
+def close_item(sender):
+    w = callback_items.pop(sender)
+    key, cleanup = dpg.get_item_user_data(w)
+    previews.release(key)
+    [f() for f in cleanup]
+    dpg.delete_item(w)
+
+
+def add_window_controls(parent, window: WindowLevel, cleanup: list):
+    with dpg.group(horizontal=True, parent=parent) as controls:
+        center = dpg.add_drag_float(label='Center', width=100, speed=2,
+                                    callback=lambda _, c: window.set(c, window.width))
+        width = dpg.add_drag_float(label='Width', width=100, speed=2, min_value=1, max_value=2 ** 20,
+                                   callback=lambda _, w: window.set(window.center, w))
+        dpg.add_button(label='Reset', callback=window.reset)
+
+    def update(window):
+        if window.center is not None:
+            dpg.set_value(center, window.center)
+            dpg.set_value(width, window.width)
+    update(window)
+    window.listeners.append(update)
+    cleanup.append(lambda: window.listeners.remove(update))
+    return controls
+
+
+def list_slices(directory: str, series_uid: str, get_instances):
+    # stored by 'new --instances', otherwise ordered by position, falling back to file names for series GDCM can not sort
+    if instances := [row['File'] for row in get_instances() if row['SeriesInstanceUID'] in (series_uid, None)]:
+        return [os.path.join(directory, file) for file in instances]
+    try:
+        paths = list(sitk.ImageSeriesReader.GetGDCMSeriesFileNames(directory, series_uid))
+    except RuntimeError:
+        paths = []
+    return paths or sorted(str(p) for p in Path(directory).glob('*.dcm'))
+
+
+def add_slice_browser(parent, directory: str, series_uid: str, get_instances, window: WindowLevel, cleanup: list):
+    """Adds a collapsed slice browser, slices are only listed and loaded once it is opened."""
+    state = {'texture': None, 'image': None, 'cache': None, 'show': None}
+
+    def delete():
+        if state['show'] in window.listeners:
+            window.listeners.remove(state['show'])
+        if state['cache']:
+            state['cache'].close()
+        if state['texture']:
+            dpg.delete_item(state['texture'])
+    cleanup.append(delete)
+
+    with dpg.collapsing_header(label='Slices', parent=parent) as header:
+        button = dpg.add_button(label='Browse slices', width=300, callback=lambda: start())
+
+    def start():
+        dpg.delete_item(button)
+        text = dpg.add_text('Listing slices...', parent=header)
+        slice_executor.submit(list_slices, directory, series_uid, get_instances).add_done_callback(lambda f: build(f, text))
+
+    def build(future, text):
+        if not dpg.does_item_exist(header):
+            return
+        try:
+            cache = state['cache'] = SliceCache(future.result())
+        except Exception as e:
+            return dpg.set_value(text, f'Failed to list slices: {e}')
+        if len(cache) == 0:
+            return dpg.set_value(text, 'No slices found')
+        slider = dpg.add_slider_int(parent=header, min_value=0, max_value=len(cache) - 1, default_value=len(cache) // 2,
+                                    width=300, callback=lambda _, index: show(index), before=text)
+        plot = dpg.add_plot(parent=header, height=preview_size // 2, width=preview_size // 2)
+        [dpg.add_plot_axis(axis, no_tick_marks=True, parent=plot) for axis in [dpg.mvXAxis, dpg.mvYAxis]]
+
+        def draw(index, future):
+            if index != dpg.get_value(slider) or not dpg.does_item_exist(plot):
+                return
+            try:
+                img, slope, intercept = future.result()
+            except Exception as e:
+                return dpg.set_value(text, f'{index + 1}/{len(cache)}: failed to load ({e})')
+            # raw textures share the buffer, so it is levelled in place unless the slice size changes
+            if state['texture'] is None or state['image'].shape[:2] != img.shape[:2]:
+                rgba = window.apply(img, slope, intercept)
+                if state['texture']:
+                    dpg.delete_item(state['texture'])
+                height, width = rgba.shape[:2]
+                state['texture'] = dpg.add_raw_texture(width, height, rgba, format=dpg.mvFormat_Float_rgba, parent='textures')
+                dpg.delete_item(plot, children_only=True, slot=2)
+                dpg.draw_image(state['texture'], pmin=[0, 0], pmax=[1, 1], parent=plot)
+            else:
+                rgba = window.apply(img, slope, intercept, rgba=state['image'])
+                dpg.set_value(state['texture'], rgba)
+            state['image'] = rgba
+
+        def show(index):
+            dpg.set_value(text, f'{index + 1}/{len(cache)}: {os.path.basename(cache.paths[index])}')
+            cache.get(index).add_done_callback(functools.partial(draw, index))
+
+        show(dpg.get_value(slider))
+        state['show'] = lambda _: show(dpg.get_value(slider))
+        window.listeners.append(state['show'])
+
+
+def load_preview(path: str):
+    """Decodes a DICOM into raw (pixels, slope, intercept), downsampled to at most preview_size pixels."""
+    img, slope, intercept = pixels.read_pixels(path)
+    # contiguous, so lookups do not stride through the full resolution buffer
+    return np.ascontiguousarray(pixels.downsample(img, preview_size)), slope, intercept
+
+
+def to_rgba(img: np.ndarray):
+    # flipped vertically, plots draw from the bottom up
+    rgba = np.ones((*img.shape[:2], 4), dtype=np.float32)
+    rgba[..., :3] = np.clip(img[::-1], 0, 1)
+    return rgba
+
+
 def callback_toggle_item(sender, _, user_data):
     rows = dpg.get_item_children(user_data, 1)
     collapse = dpg.get_item_label(sender) == 'Collapse'
@@ -28,6 +28,9 @@ setup(
         'GDCM~=1.1',
         'pylibjpeg~=1.4'
     ],
+    extras_require={
+        'parquet': ['pyarrow']
+    },
     entry_points={
         'console_scripts': [
             'dataviewer = dataviewer:cli',